@@ -0,0 +1,221 @@
+"""
+caching of AEAD lookups in front of an AEAD backend
+"""
+
+import collections
+import multiprocessing
+import threading
+import time
+
+__all__ = [
+    # constants
+    # functions
+    # classes
+    'CachingBackend',
+    'InvalidationLog',
+]
+
+import ksmexception
+
+class InvalidationLog():
+    """
+    Ring buffer of invalidated public ids in shared memory.
+
+    Created before the KSM forks its workers, so that an invalidation requested
+    through any one worker (or by a signal to the parent) reaches the caches of
+    all of them. A cache that has fallen more than `slots' invalidations behind
+    just flushes everything.
+    """
+
+    id_size = 16
+
+    def __init__(self, slots = 1024):
+        self.slots = slots
+        self._ids = multiprocessing.RawArray('c', slots * self.id_size)
+        self._seq = multiprocessing.RawValue('Q', 0)
+        self._flushes = multiprocessing.RawValue('Q', 0)
+        self._lock = multiprocessing.Lock()
+
+    def invalidate(self, public_id):
+        """
+        Invalidate the cached AEAD of `public_id' in all processes.
+        """
+        data = public_id.encode('ascii')[:self.id_size].ljust(self.id_size, b'\x00')
+        with self._lock:
+            seq = self._seq.value
+            offset = (seq % self.slots) * self.id_size
+            self._ids[offset:offset + self.id_size] = data
+            self._seq.value = seq + 1
+
+    def flush_all(self):
+        """
+        Invalidate all cached AEADs in all processes.
+
+        Does not take any locks, so it is safe to call from a signal handler.
+        """
+        self._flushes.value += 1
+
+    def position(self):
+        """ Return the current (sequence, flushes) position in the log. """
+        return (self._seq.value, self._flushes.value)
+
+    def changes(self, seen):
+        """
+        Return the public ids invalidated since position `seen', or None if
+        everything has to be flushed.
+        """
+        seq, flushes = seen
+        if flushes != self._flushes.value:
+            return None
+        end = self._seq.value
+        if end - seq > self.slots:
+            return None
+        res = []
+        for this in range(seq, end):
+            offset = (this % self.slots) * self.id_size
+            res.append(self._ids[offset:offset + self.id_size].rstrip(b'\x00').decode('ascii'))
+        return res
+
+class CachingBackend():
+    """
+    Bounded LRU cache of AEADs keyed by public id, wrapping an AEAD backend
+    (FSBackend or SQLBackend) and exposing the same interface.
+
+    Unknown public ids (the backend raising L{ksmexception.YHSM_AEADNotFound})
+    are remembered too, for `negative_ttl' seconds. Other backend errors are
+    never cached.
+
+    @param backend: The AEAD backend to cache lookups of
+    @param size: Maximum number of cached public ids
+    @param ttl: Seconds to keep AEADs, 0 to keep them until evicted
+    @param negative_ttl: Seconds to remember unknown public ids, 0 to not remember them
+    @param invalidations: Shared log of invalidated public ids to follow
+    @param count: Called with the name of a counter to increment on cache hits,
+                  misses and evictions
+    @type size: integer
+    @type ttl: integer
+    @type negative_ttl: integer
+    @type invalidations: L{InvalidationLog}
+    @type count: callable
+    """
+
+    def __init__(self, backend, size, ttl = 0, negative_ttl = 0, invalidations = None, count = None):
+        if size < 1:
+            raise ValueError('Cache size must be at least 1, was %d' % (size))
+        self.backend = backend
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.invalidations = invalidations
+        self._count = count if count is not None else (lambda name: None)
+        # public_id -> (expires, aead or None, reason for unknown public_id)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._seen = invalidations.position() if invalidations is not None else None
+
+    def load_aead(self, public_id):
+        self._follow_invalidations()
+        entry = self._lookup(public_id)
+        if entry is not None:
+            (_, aead, reason) = entry
+            if aead is None:
+                self._count('cache_negative_hit')
+                raise ksmexception.YHSM_AEADNotFound(public_id, reason)
+            self._count('cache_hit')
+            return aead
+
+        self._count('cache_miss')
+        generation = self._generation
+        try:
+            aead = self.backend.load_aead(public_id)
+        except ksmexception.YHSM_AEADNotFound as e:
+            self._store(generation, public_id, None, e.reason)
+            raise
+        self._store(generation, public_id, aead, None)
+        return aead
+
+    def load_aeads(self, public_ids):
+        self._follow_invalidations()
+        res = {}
+        missing = []
+        for public_id in public_ids:
+            entry = self._lookup(public_id)
+            if entry is None:
+                self._count('cache_miss')
+                missing.append(public_id)
+            elif entry[1] is None:
+                self._count('cache_negative_hit')
+            else:
+                self._count('cache_hit')
+                res[public_id] = entry[1]
+
+        if missing:
+            generation = self._generation
+            found = self.backend.load_aeads(missing)
+            for public_id in missing:
+                aead = found.get(public_id)
+                if aead is None:
+                    self._store(generation, public_id, None, "No AEAD found for public_id {}".format(public_id))
+                else:
+                    self._store(generation, public_id, aead, None)
+                    res[public_id] = aead
+        return res
+
+    def invalidate(self, public_id = None):
+        """
+        Forget the cached AEAD of `public_id', or all cached AEADs if it is None.
+        """
+        with self._lock:
+            self._generation += 1
+            if public_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(public_id, None)
+
+    def close(self):
+        self.backend.close()
+
+    def _lookup(self, public_id):
+        """ Return the unexpired cache entry for public_id, or None. """
+        with self._lock:
+            entry = self._entries.get(public_id)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= time.monotonic():
+                del self._entries[public_id]
+                return None
+            self._entries.move_to_end(public_id)
+            return entry
+
+    def _store(self, generation, public_id, aead, reason):
+        ttl = self.ttl if aead is not None else self.negative_ttl
+        if aead is None and not ttl:
+            return
+        expires = time.monotonic() + ttl if ttl else None
+        evicted = 0
+        with self._lock:
+            if generation != self._generation:
+                # invalidated while we were loading it
+                return
+            self._entries[public_id] = (expires, aead, reason)
+            self._entries.move_to_end(public_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+                evicted += 1
+        for _ in range(evicted):
+            self._count('cache_eviction')
+
+    def _follow_invalidations(self):
+        """ Apply invalidations requested through the shared log since we last looked. """
+        if self.invalidations is None or self.invalidations.position() == self._seen:
+            return
+        with self._lock:
+            position = self.invalidations.position()
+            changes = self.invalidations.changes(self._seen)
+            self._seen = position
+        if changes is None:
+            self.invalidate()
+            return
+        for public_id in changes:
+            self.invalidate(public_id or None)
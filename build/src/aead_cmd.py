@@ -256,8 +256,8 @@ class YHSM_GeneratedAEAD():
 class YHSM_YubiKeySecret():
     """ Small class to represent a YUBIKEY_SECRETS struct. """
     def __init__(self, key, uid):
-        self.key = util.input_validate_str(key, 'key', exact_len = defines.KEY_SIZE)
-        self.uid = util.input_validate_str(uid, 'uid', max_len = defines.UID_SIZE)
+        self.key = util.input_validate_bytes(key, 'key', exact_len = defines.KEY_SIZE)
+        self.uid = util.input_validate_bytes(uid, 'uid', max_len = defines.UID_SIZE)
 
     def pack(self):
         """ Return key and uid packed for sending in a command to the YubiHSM. """
@@ -266,4 +266,4 @@ class YHSM_YubiKeySecret():
         #   uint8_t key[KEY_SIZE];              // AES key
         #   uint8_t uid[UID_SIZE];              // Unique (secret) ID
         # } YUBIKEY_SECRETS;
-        return self.key + self.uid.ljust(defines.UID_SIZE, chr(0))
+        return self.key + self.uid.ljust(defines.UID_SIZE, b'\x00')
@@ -0,0 +1,162 @@
+"""
+packed AEAD store: all AEADs for one key handle in a single memory mapped file
+
+File layout (little endian) :
+
+  header  : magic 'YKSMPACK', uint32 version, uint32 key handle,
+            uint32 number of records, uint32 AEAD size
+  records : fixed size, sorted by public id
+            char public_id[16]  (modhex, NUL padded)
+            uint8 nonce[YSM_AEAD_NONCE_SIZE]
+            uint8 aead_len
+            uint8 aead[AEAD size]
+
+Lookups are a binary search over the mapped records. Packs are replaced by
+writing a new file next to the old one and renaming it into place.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import tempfile
+
+__all__ = [
+    # constants
+    'YHSM_AEAD_Pack_Marker',
+    # functions
+    'aead_pack_filename',
+    'write_aead_pack',
+    # classes
+    'AEADPack',
+]
+
+import aead_cmd
+import defines
+import ksmexception
+
+YHSM_AEAD_Pack_Marker = b'YKSMPACK'
+
+_header = struct.Struct('< 8s I I I I')
+_public_id_size = 16
+_version = 1
+
+
+def aead_pack_filename(pack_dir, key_handle):
+    """
+    Return the filename of the AEAD pack for this key handle.
+    """
+    return os.path.join(pack_dir, "{}.aeadpack".format(key_handle))
+
+
+def _record_struct(aead_size):
+    return struct.Struct('< {:d}s {:d}s B {:d}s'.format(
+        _public_id_size, defines.YSM_AEAD_NONCE_SIZE, aead_size))
+
+
+def _pack_public_id(public_id):
+    public_id = public_id.encode('ascii') if isinstance(public_id, str) else public_id
+    if len(public_id) > _public_id_size:
+        raise ksmexception.YHSM_InputTooLong('public_id', _public_id_size, len(public_id))
+    return public_id.ljust(_public_id_size, b'\x00')
+
+
+def write_aead_pack(filename, key_handle, aeads):
+    """
+    Atomically create or replace the AEAD pack `filename'.
+
+    @param key_handle: The key handle all the AEADs are encrypted with
+    @param aeads: (public_id, YHSM_GeneratedAEAD) pairs
+    @type key_handle: integer
+    @type aeads: iterable
+
+    @returns: number of AEADs written
+    @rtype: integer
+    """
+    records = []
+    for public_id, aead in aeads:
+        if aead.key_handle != key_handle:
+            raise ksmexception.YHSM_Error("AEAD for {} has key handle 0x{:x}, expected 0x{:x}".format(
+                public_id, aead.key_handle, key_handle))
+        records.append((_pack_public_id(public_id), aead.nonce, aead.data))
+    records.sort(key = lambda this: this[0])
+    aead_size = max([len(data) for (_, _, data) in records] + [defines.YSM_YUBIKEY_AEAD_SIZE])
+    record = _record_struct(aead_size)
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_name = tempfile.mkstemp(prefix = '.' + os.path.basename(filename), dir = dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_header.pack(YHSM_AEAD_Pack_Marker, _version, key_handle, len(records), aead_size))
+            prev = None
+            for public_id, nonce, data in records:
+                if public_id == prev:
+                    raise ksmexception.YHSM_Error("Duplicate public_id {}".format(public_id.rstrip(b'\x00')))
+                prev = public_id
+                f.write(record.pack(public_id, nonce or b'', len(data), data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_name, 0o600)
+        os.replace(tmp_name, filename)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    return len(records)
+
+
+class _PackKeys():
+    """ Sequence view of the public ids in a pack, for bisect. """
+    def __init__(self, pack):
+        self.pack = pack
+
+    def __len__(self):
+        return self.pack.count
+
+    def __getitem__(self, i):
+        offset = _header.size + i * self.pack.record_size
+        return self.pack.data[offset:offset + _public_id_size]
+
+
+class AEADPack():
+    """
+    A read only, memory mapped AEAD pack.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.identity = (st.st_dev, st.st_ino, st.st_mtime_ns)
+            self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version, self.key_handle, self.count, self.aead_size = _header.unpack_from(self.data, 0)
+        if magic != YHSM_AEAD_Pack_Marker or version != _version:
+            raise ksmexception.YHSM_Error("Unknown AEAD pack format in '{}'".format(filename))
+        self._record = _record_struct(self.aead_size)
+        self.record_size = self._record.size
+        if len(self.data) != _header.size + self.count * self.record_size:
+            raise ksmexception.YHSM_Error("Truncated AEAD pack '{}'".format(filename))
+        self._keys = _PackKeys(self)
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, public_id):
+        """
+        Return the YHSM_GeneratedAEAD for public_id, or None.
+        """
+        target = _pack_public_id(public_id)
+        i = bisect.bisect_left(self._keys, target)
+        if i == self.count or self._keys[i] != target:
+            return None
+        _, nonce, aead_len, data = self._record.unpack_from(self.data, _header.size + i * self.record_size)
+        return aead_cmd.YHSM_GeneratedAEAD(nonce, self.key_handle, data[:aead_len])
+
+    def __iter__(self):
+        """ Yield (public_id, YHSM_GeneratedAEAD) for all records. """
+        for i in range(self.count):
+            public_id, nonce, aead_len, data = self._record.unpack_from(
+                self.data, _header.size + i * self.record_size)
+            yield (public_id.rstrip(b'\x00').decode('ascii'),
+                   aead_cmd.YHSM_GeneratedAEAD(nonce, self.key_handle, data[:aead_len]))
+
+    def close(self):
+        self.data.close()
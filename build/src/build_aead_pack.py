@@ -0,0 +1,88 @@
+"""
+Build packed AEAD files (see aead_pack) for the KSM's --aead-pack option, from
+an AEAD directory tree or from the aead_table of a database.
+
+The packs are written to a temporary file and renamed into place, so this can
+be run against the directory a running KSM serves from.
+"""
+import os
+import sys
+import argparse
+
+import aead_pack
+import util
+from ksm import FSBackend, SQLBackend
+
+default_dir = "/var/cache/yubikey-ksm/aeads"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Build packed AEAD files',
+                                     add_help = True,
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter,
+                                     )
+    parser.add_argument('-B', '--aead-dir',
+                        dest='aead_dir',
+                        default=default_dir,
+                        required=False,
+                        help='AEAD directory to read AEADs from',
+                        metavar='DIR',
+                        )
+    parser.add_argument('--db-url',
+                        dest='db_url',
+                        required=False,
+                        help='The database url to read the AEADs from instead of the AEAD '
+                        'directory, you can also use env:YOURENVVAR to instead read the URL '
+                        'from the YOURENVVAR environment variable.',
+                        metavar='DBURL',
+                        )
+    parser.add_argument('-O', '--output-dir',
+                        dest='output_dir',
+                        required=True,
+                        help='Directory to write the AEAD packs to',
+                        metavar='DIR',
+                        )
+    parser.add_argument('--key-handle', '--key-handles',
+                        dest='key_handles',
+                        nargs='+',
+                        required=True,
+                        help='Key handle(s) to build AEAD packs for',
+                        metavar='HANDLE',
+                        )
+    parser.add_argument('-v', '--verbose',
+                        dest='verbose',
+                        action='store_true', default=False,
+                        help='Enable verbose operation',
+                        )
+    return parser.parse_args()
+
+def args_fixup(args):
+    if args.db_url and args.db_url.startswith('env:'):
+        env_var = args.db_url[4:]
+        if env_var in os.environ:
+            args.db_url = os.environ[env_var]
+
+    if not os.path.isdir(args.output_dir):
+        sys.stderr.write("Output directory '%s' does not exist.\n" % (args.output_dir))
+        sys.exit(1)
+
+def main():
+    args = parse_args()
+    args_fixup(args)
+
+    key_handles = [(kh, util.key_handle_to_int(kh)) for kh in args.key_handles]
+    if args.db_url:
+        source = SQLBackend(args.db_url)
+    else:
+        source = FSBackend(args.aead_dir, key_handles)
+
+    for kh, kh_int in key_handles:
+        filename = aead_pack.aead_pack_filename(args.output_dir, kh)
+        count = aead_pack.write_aead_pack(filename, kh_int, source.all_aeads(kh))
+        if args.verbose:
+            print("Wrote {:d} AEADs for key handle {} to '{}'".format(count, kh, filename))
+
+    source.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""
+Check the error rate limiting of ksm_log.LogPipeline.
+
+  - N identical errors : `error_burst' are logged, the rest are suppressed,
+    and the first one logged after the window reports how many were.
+  - Errors differing only in the exception object (YHSM_Error includes its
+    address in str()) are identical once logged through ksm.error_reason().
+  - A flood of distinct errors beyond LogPipeline.max_limits does not reset
+    the suppression of an error that keeps repeating.
+
+Exits with status 1 if any check fails.
+"""
+import io
+import sys
+import time
+import syslog
+import argparse
+import collections
+
+import ksm_log
+import ksmexception
+from ksm import error_reason
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Check the rate limiting of the KSM log pipeline',
+                                     add_help = True,
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter,
+                                     )
+    parser.add_argument('-n', '--errors',
+                        dest='errors',
+                        type=int, default=100,
+                        required=False,
+                        help='Number of identical errors to log',
+                        metavar='NUM',
+                        )
+    parser.add_argument('--error-burst',
+                        dest='error_burst',
+                        type=int, default=10,
+                        required=False,
+                        help='Identical errors logged per rate limit window',
+                        metavar='NUM',
+                        )
+    parser.add_argument('-v', '--verbose',
+                        dest='verbose',
+                        action='store_true', default=False,
+                        help='Enable verbose operation',
+                        )
+    return parser.parse_args()
+
+def run_pipeline(func, **kwargs):
+    """
+    Call func(pipeline) on a new LogPipeline and return (lines written to
+    stderr, counters incremented).
+    """
+    counts = collections.Counter()
+    pipeline = ksm_log.LogPipeline(count = lambda name: counts.update([name]), **kwargs)
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    try:
+        func(pipeline)
+        pipeline.flush()
+        lines = sys.stderr.getvalue().splitlines()
+    finally:
+        sys.stderr = stderr
+    return lines, counts
+
+def log_unknown_public_id(pipeline, public_id = 'cccccccccccb'):
+    """ Log an error the way YHSM_KSMRequestHandler.log_error does. """
+    e = ksmexception.YHSM_AEADNotFound(public_id, "No AEAD found")
+    args = (public_id, error_reason(e))
+    pipeline.log(False, syslog.LOG_ERR, "%s - - Unknown public_id %s : %s", '127.0.0.1', *args,
+                 limit_key = args)
+
+def check_burst(args):
+    def run(pipeline):
+        for _ in range(args.errors):
+            log_unknown_public_id(pipeline)
+        time.sleep(1.1)
+        log_unknown_public_id(pipeline)
+
+    lines, counts = run_pipeline(run, error_burst = args.error_burst, error_window = 1)
+    suppressed = args.errors - args.error_burst
+    failed = []
+    if len(lines) != args.error_burst + 1:
+        failed.append("{:d} of {:d} errors logged, expected {:d}".format(
+            len(lines) - 1, args.errors, args.error_burst))
+    if counts['log_suppressed'] != suppressed:
+        failed.append("{:d} errors counted as suppressed, expected {:d}".format(
+            counts['log_suppressed'], suppressed))
+    if not lines or not lines[-1].endswith("({:d} similar messages suppressed)".format(suppressed)):
+        failed.append("no count of suppressed messages after the window : {!r}".format(lines[-1:]))
+    return failed
+
+def check_distinct_flood(args):
+    max_limits = ksm_log.LogPipeline.max_limits
+
+    def run(pipeline):
+        for i in range(2 * max_limits):
+            log_unknown_public_id(pipeline)
+            log_unknown_public_id(pipeline, "{:012x}".format(i))
+
+    lines, counts = run_pipeline(run, error_burst = args.error_burst, error_window = 60)
+    repeated = len([line for line in lines if 'cccccccccccb' in line])
+    failed = []
+    if repeated != args.error_burst:
+        failed.append("repeated error logged {:d} times among {:d} distinct ones, expected {:d}".format(
+            repeated, 2 * max_limits, args.error_burst))
+    return failed
+
+def main():
+    args = parse_args()
+    failures = 0
+    for name, check in [('burst', check_burst), ('distinct_flood', check_distinct_flood)]:
+        failed = check(args)
+        if failed:
+            failures += 1
+            for reason in failed:
+                print("{} : {} FAILED".format(name, reason))
+        elif args.verbose:
+            print("{} : OK".format(name))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""
+Check soft_hsm.aesCCM and soft_hsm.crc16 against known-answer vectors.
+
+soft_hsm_vectors.json was produced by the implementation these functions had
+before they were rewritten for speed (soft_hsm.py as of commit 2e52daf, with
+the CTR mode keystream built from a counter callback, a separate CBC-MAC pass
+and a bit by bit crc16). For every aesCCM vector the ciphertext must match,
+it must decrypt back to the plaintext (with and without a prepared `key_aes'),
+and the copy with one bit flipped, in the MAC for even entries and in the
+encrypted data for odd ones, must be rejected.
+
+Exits with status 1 if any vector fails.
+"""
+import os
+import sys
+import json
+import argparse
+
+from Crypto.Cipher import AES
+
+import ksmexception
+import soft_hsm
+
+default_vectors = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'soft_hsm_vectors.json')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Check the software HSM against known-answer vectors',
+                                     add_help = True,
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter,
+                                     )
+    parser.add_argument('--vectors',
+                        dest='vectors',
+                        default=default_vectors,
+                        required=False,
+                        help='JSON file with the known-answer vectors',
+                        metavar='FILENAME',
+                        )
+    parser.add_argument('-v', '--verbose',
+                        dest='verbose',
+                        action='store_true', default=False,
+                        help='Enable verbose operation',
+                        )
+    return parser.parse_args()
+
+def check_aes_ccm(vector):
+    """ Return a list of the ways `vector' failed, empty if it passed. """
+    key = bytes.fromhex(vector['key'])
+    kh = vector['key_handle']
+    nonce = bytes.fromhex(vector['nonce'])
+    plaintext = bytes.fromhex(vector['plaintext'])
+    ciphertext = bytes.fromhex(vector['ciphertext'])
+    failed = []
+    if soft_hsm.aesCCM(key, kh, nonce, plaintext, False) != ciphertext:
+        failed.append('encrypt')
+    try:
+        if soft_hsm.aesCCM(key, kh, nonce, ciphertext, True) != plaintext:
+            failed.append('decrypt')
+        key_aes = AES.new(key, AES.MODE_ECB)
+        if soft_hsm.aesCCM(key, kh, nonce, ciphertext, True, key_aes) != plaintext:
+            failed.append('decrypt with key_aes')
+    except ksmexception.YHSM_Error:
+        failed.append('decrypt rejected')
+    try:
+        soft_hsm.aesCCM(key, kh, nonce, bytes.fromhex(vector['tampered']), True)
+        failed.append('tampered accepted')
+    except ksmexception.YHSM_Error:
+        pass
+    return failed
+
+def main():
+    args = parse_args()
+    with open(args.vectors, 'r') as f:
+        vectors = json.load(f)
+
+    failures = 0
+    for i, vector in enumerate(vectors['aesCCM']):
+        failed = check_aes_ccm(vector)
+        if failed:
+            failures += 1
+            print("aesCCM vector {:d} (key handle {}, {:d} bytes) : {} FAILED".format(
+                i, vector['key_handle'], len(vector['plaintext']) // 2, ', '.join(failed)))
+    for i, vector in enumerate(vectors['crc16']):
+        got = soft_hsm.crc16(bytes.fromhex(vector['data']))
+        if got != vector['crc16']:
+            failures += 1
+            print("crc16 vector {:d} : got 0x{:04x}, expected 0x{:04x} FAILED".format(i, got, vector['crc16']))
+
+    if args.verbose or failures:
+        print("{:d} aesCCM and {:d} crc16 vectors checked, {:d} failed".format(
+            len(vectors['aesCCM']), len(vectors['crc16']), failures))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
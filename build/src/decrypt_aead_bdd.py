@@ -3,6 +3,7 @@ import argparse
 import sqlalchemy
 import soft_hsm
 import defines
+import yubikey
 
 def parse_args():
     parser = argparse.ArgumentParser(description = 'Decrypt AEADs',
@@ -20,9 +21,38 @@ def parse_args():
                         help='The first public id to decrypt',
                         metavar='INT-OR-MODHEX',
                         )
+    parser.add_argument('--last-public-id',
+                        dest='last_public_id',
+                        required=False,
+                        help='Decrypt all public ids from --public-id up to and including this one, '
+                        'using a single query',
+                        metavar='INT-OR-MODHEX',
+                        )
+    parser.add_argument('--public-id-chars',
+                        dest='public_id_chars',
+                        type=int, default=12,
+                        required=False,
+                        help='Number of chars in public ids given as integers',
+                        )
 
     return parser.parse_args()
 
+def public_id_fixup(public_id, public_id_chars):
+    """
+    Return (number, modhex) for a public id given as integer or modhex.
+    """
+    try:
+        n = int(public_id)
+        return n, yubikey.modhex_encode(("%x" % n).rjust(public_id_chars, '0'))
+    except ValueError:
+        return int(yubikey.modhex_decode(public_id), 16), public_id
+
+def ykman_command(hsm, public_id, keyhandle, aead, nonce):
+    pt = soft_hsm.aesCCM(hsm.keys[keyhandle], keyhandle, bytes([ ord(c) for c in nonce ]), aead, decrypt = True)
+    key = pt[:defines.KEY_SIZE]
+    uid = pt[defines.KEY_SIZE:]
+    return "ykman otp yubiotp 1 -P {} -p {} -k {}".format(public_id,''.join(["%02x" % x for x in uid]),''.join(["%02x" % x for x in key]))
+
 def main():
 
     args = parse_args()
@@ -30,15 +60,29 @@ def main():
 
     engine = sqlalchemy.create_engine('mysql://'+os.environ['USER']+':'+os.environ['PASSWORD']+'@'+os.environ['DATABASEIP']+'/'+os.environ['DATABASE'])
     connection = engine.connect()
-    sql = sqlalchemy.sql.text("SELECT * FROM aead_table WHERE public_id = :public_id;")
-    result = connection.execute(sql, {'public_id': args.public_id}).fetchall()
-    
     hsm = soft_hsm.SoftYHSM.from_file(args.device)
-    pt = soft_hsm.aesCCM(hsm.keys[result[0][1]], result[0][1], bytes(result[0][3],encoding="utf-8" ), result[0][2], decrypt = True)
-    key = pt[:defines.KEY_SIZE]
-    uid = pt[defines.KEY_SIZE:]
-    
-    print("ykman otp yubiotp 1 -P {} -p {} -k {}".format(args.public_id,''.join(["%02x" % x for x in uid]),''.join(["%02x" % x for x in key])))
+
+    if not args.last_public_id:
+        sql = sqlalchemy.sql.text("SELECT * FROM aead_table WHERE public_id = :public_id;")
+        result = connection.execute(sql, {'public_id': args.public_id}).fetchall()
+
+        print(ykman_command(hsm, args.public_id, result[0][1], result[0][2], result[0][3]))
+        return
+
+    first, first_id = public_id_fixup(args.public_id, args.public_id_chars)
+    last, _ = public_id_fixup(args.last_public_id, args.public_id_chars)
+    width = len(first_id)
+    public_ids = [yubikey.modhex_encode(("%x" % n).rjust(width, '0')) for n in range(first, last + 1)]
+    sql = sqlalchemy.sql.text("SELECT public_id, keyhandle, aead, nonce FROM aead_table WHERE public_id IN :public_ids;")
+    sql = sql.bindparams(sqlalchemy.bindparam('public_ids', expanding = True))
+    rows = {}
+    for row in connection.execute(sql, {'public_ids': public_ids}):
+        if row[1] in hsm.keys:
+            rows.setdefault(row[0], row)
+    for public_id in public_ids:
+        if public_id in rows:
+            _, keyhandle, aead, nonce = rows[public_id]
+            print(ykman_command(hsm, public_id, keyhandle, aead, nonce))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
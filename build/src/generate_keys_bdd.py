@@ -3,7 +3,10 @@ import binascii
 import util
 import os
 import sys
+import json
+import time
 import argparse
+import multiprocessing
 import yubikey
 import sqlalchemy
 import aead_cmd
@@ -13,6 +16,7 @@ import defines
 
 default_device = "/dev/ttyACM0"
 default_dir = "/var/cache/yubikey-ksm/aeads"
+default_batch_size = 1000
 
 def parse_args():
     """
@@ -69,23 +73,43 @@ def parse_args():
                         action='store_true', default=False,
                         help='Let the HSM generate nonce',
                         )
+    parser.add_argument('--bulk',
+                        dest='bulk',
+                        required=False,
+                        action='store_true', default=False,
+                        help='Generate the secrets in a pool of worker processes and insert '
+                        'them in batches of multi-row INSERTs',
+                        )
+    parser.add_argument('--batch-size',
+                        dest='batch_size',
+                        type=int, default=default_batch_size,
+                        required=False,
+                        help='Number of public ids inserted per transaction in bulk mode',
+                        )
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int, default=multiprocessing.cpu_count(),
+                        required=False,
+                        help='Number of worker processes generating AEADs in bulk mode',
+                        )
+    parser.add_argument('--resume-file',
+                        dest='resume_file',
+                        required=False,
+                        help='File recording the progress of a bulk run. If it exists, '
+                        'the interrupted run it describes is continued.',
+                        )
     return parser.parse_args()
 
-def args_fixup(args):
+def args_fixup(args, engine):
     # if not os.path.isdir(args.output_dir):
     #     sys.stderr.write("Output directory '%s' does not exist.\n" % (args.output_dir))
     #     sys.exit(1)
 
     keyhandles_fixup(args)
-    maxres = 0
 
-    #Recherche des identifiants en BDD
-    myresult = get_last_id()
-    for val in myresult:
-        #Recherche de l'identifiants maximum
-        calc = start_id_fixup(val[0])
-        if(calc>maxres):
-            maxres = calc
+    #Recherche de l'identifiant maximum en BDD
+    last_id = get_last_id(engine)
+    maxres = start_id_fixup(last_id) if last_id else 0
 
     args.start_id = start_id_fixup(maxres)+1
 
@@ -102,14 +126,29 @@ def start_id_fixup(start_id):
 
     return n
         
-def get_last_id():
+def new_engine():
+    """ Create the (pooled) engine for the database given in the environment. """
+    return sqlalchemy.create_engine('mysql://'+os.environ['USER']+':'+os.environ['PASSWORD']+'@'+os.environ['DATABASEIP']+'/'+os.environ['DATABASE'])
 
-    engine = sqlalchemy.create_engine('mysql://'+os.environ['USER']+':'+os.environ['PASSWORD']+'@'+os.environ['DATABASEIP']+'/'+os.environ['DATABASE'])
+def get_last_id(engine):
+    """
+    Return the highest public_id (modhex) in the database, or None if it is empty.
+
+    Modhex 'c' is 0 and 'b' is 1, so swapping them makes the string order of
+    equally long public ids match their numeric order and lets the database
+    compute the MAX() for us.
+    """
+    sql = sqlalchemy.sql.text(
+        "SELECT MAX(REPLACE(REPLACE(REPLACE(public_id, 'b', '#'), 'c', 'b'), '#', 'c')) FROM aead_table "
+        "WHERE LENGTH(public_id) = (SELECT MAX(LENGTH(public_id)) FROM aead_table);")
     connection = engine.connect()
-    sql = sqlalchemy.sql.text("SELECT public_id FROM aead_table;")
-    # insert query
-    result = connection.execute(sql).fetchall()
-    return result
+    try:
+        swapped = connection.execute(sql).scalar()
+    finally:
+        connection.close()
+    if not swapped:
+        return None
+    return swapped.translate(str.maketrans('bc', 'cb'))
 
 def keyhandles_fixup(args):
     """
@@ -125,10 +164,11 @@ def keyhandles_fixup(args):
 
     args.key_handles = new_handles
 
-def insert_query(publicId, aead, keyhandle):
-    engine = sqlalchemy.create_engine('mysql://'+os.environ['USER']+':'+os.environ['PASSWORD']+'@'+os.environ['DATABASEIP']+'/'+os.environ['DATABASE'])
+def get_table(engine):
     metadata = sqlalchemy.MetaData()
-    aeadobj = sqlalchemy.Table('aead_table', metadata, autoload=True, autoload_with=engine)
+    return sqlalchemy.Table('aead_table', metadata, autoload=True, autoload_with=engine)
+
+def insert_query(engine, aeadobj, publicId, aead, keyhandle):
     connection = engine.connect()
 
     # turn the keyhandle into an integer
@@ -144,14 +184,17 @@ def insert_query(publicId, aead, keyhandle):
         return result
     except sqlalchemy.exc.IntegrityError:
         pass
+    finally:
+        connection.close()
     return None
 
-def gen_keys(hsm, args):
+def gen_keys(hsm, args, engine):
+    aeadobj = get_table(engine)
     for int_id in range(args.start_id, args.start_id + args.count):
 
         public_id = ("%x" % int_id).rjust(args.public_id_chars, '0')
         padded_id = yubikey.modhex_encode(public_id)
-        num_bytes = len(aead_cmd.YHSM_YubiKeySecret('a' * 16, 'b' * 6).pack())
+        num_bytes = len(aead_cmd.YHSM_YubiKeySecret(b'a' * 16, b'b' * 6).pack())
         hsm.load_random(num_bytes)
 
         nonce = ""
@@ -167,17 +210,132 @@ def gen_keys(hsm, args):
             # key = pt[:defines.KEY_SIZE]
             # uid = pt[defines.KEY_SIZE:]
 
-        if not insert_query(padded_id, aead, kh):
+        if not insert_query(engine, aeadobj, padded_id, aead, kh):
             print("WARNING: could not insert {}".format(public_id))
 
 
+_worker_hsm = None
+
+def _bulk_worker_init(keys):
+    global _worker_hsm
+    _worker_hsm = SoftYHSM(keys)
+
+def _bulk_generate(job):
+    """
+    Generate a secret for public id `int_id' and encrypt it with each key handle.
+    Runs in the worker processes, returns the rows to insert.
+    """
+    int_id, public_id_chars, key_handles, random_nonce = job
+    public_id = ("%x" % int_id).rjust(public_id_chars, '0')
+    padded_id = yubikey.modhex_encode(public_id)
+    num_bytes = len(aead_cmd.YHSM_YubiKeySecret(b'a' * 16, b'b' * 6).pack())
+    _worker_hsm.load_random(num_bytes)
+    rows = []
+    for kh in key_handles:
+        nonce = b"" if random_nonce else bytes.fromhex(public_id)
+        aead = _worker_hsm.generate_aead(nonce, kh)
+        rows.append({'public_id': padded_id,
+                     'keyhandle': aead.key_handle,
+                     'nonce': ''.join([ chr(c) for c in aead.nonce ]),
+                     'aead': aead.data})
+    return rows
+
+def load_progress(filename):
+    if not filename or not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def save_progress(filename, progress):
+    if not filename:
+        return
+    tmp_name = filename + '.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump(progress, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_name, filename)
+
+def bulk_gen_keys(hsm, args, engine):
+    """
+    Generate args.count secrets in a pool of worker processes and insert
+    them using one multi-row INSERT per batch, each batch in its own transaction.
+
+    Progress is recorded in args.resume_file after every batch, so that a
+    crashed run can be continued where it stopped.
+    """
+    progress = load_progress(args.resume_file)
+    if progress is None:
+        progress = {'start_id': args.start_id,
+                    'end_id': args.start_id + args.count,
+                    'next_id': args.start_id}
+    else:
+        # The last batch may have been committed without being recorded.
+        progress['next_id'] = max(progress['next_id'], args.start_id)
+        print("Resuming run for public ids {} to {} at {}".format(
+            progress['start_id'], progress['end_id'] - 1, progress['next_id']))
+        sys.stdout.flush()
+    save_progress(args.resume_file, progress)
+
+    aeadobj = get_table(engine)
+    key_handles = list(args.key_handles.keys())
+    jobs = ((int_id, args.public_id_chars, key_handles, args.random_nonce)
+            for int_id in range(progress['next_id'], progress['end_id']))
+    total = progress['end_id'] - progress['next_id']
+    done = 0
+    started = time.time()
+
+    pool = multiprocessing.Pool(args.workers, _bulk_worker_init, (hsm.keys,))
+    try:
+        batch = []
+        results = pool.imap(_bulk_generate, jobs, chunksize = max(1, min(100, args.batch_size // args.workers)))
+        for rows in results:
+            batch.append(rows)
+            if len(batch) == args.batch_size:
+                _bulk_insert(engine, aeadobj, batch)
+                done += len(batch)
+                progress['next_id'] += len(batch)
+                save_progress(args.resume_file, progress)
+                _bulk_report(done, total, started)
+                batch = []
+        if batch:
+            _bulk_insert(engine, aeadobj, batch)
+            done += len(batch)
+            progress['next_id'] += len(batch)
+            save_progress(args.resume_file, progress)
+            _bulk_report(done, total, started)
+    finally:
+        pool.terminate()
+
+    if args.resume_file:
+        os.unlink(args.resume_file)
+
+def _bulk_insert(engine, aeadobj, batch):
+    rows = [row for rows in batch for row in rows]
+    connection = engine.connect()
+    try:
+        with connection.begin():
+            connection.execute(aeadobj.insert().values(rows))
+    finally:
+        connection.close()
+
+def _bulk_report(done, total, started):
+    elapsed = time.time() - started
+    rate = done / elapsed if elapsed > 0 else 0
+    sys.stderr.write("{:d}/{:d} public ids inserted ({:.0f}/s)\n".format(done, total, rate))
+    sys.stderr.flush()
+
 def main():
     # Check des arguments par le parser
     args = parse_args()
-    args_fixup(args)
+    engine = new_engine()
+    args_fixup(args, engine)
     # Load YHSM
     hsm = SoftYHSM.from_file(args.device)
-    gen_keys(hsm, args) 
+    if args.bulk:
+        bulk_gen_keys(hsm, args, engine)
+    else:
+        gen_keys(hsm, args, engine)
 
 
 if __name__ == '__main__':
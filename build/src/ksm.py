@@ -42,35 +42,75 @@ import sys
 import http.server
 import socket
 import argparse
+import atexit
 import syslog
 import re
+import signal
+import time
+import threading
+import collections
+import selectors
 
 import yubikey
 import daemon
 import sqlalchemy
 import ksmexception
 import aead_cmd
+import aead_cache
+import aead_pack
+import ksm_stats
+import ksm_log
 import util
 import chardet
 
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from soft_hsm import SoftYHSM
 
 default_device = "/dev/ttyACM0"
 default_dir = "/var/cache/yubikey-ksm/aeads"
 default_serve_url = "/wsapi/decrypt?otp="
+default_batch_url = "/wsapi/decrypt_batch"
+default_batch_max = 1000
 default_listen_addr = "127.0.0.1"
 default_port = 8002
 default_reqtimeout = 2
 default_pid_file = None
 default_db_url = None
+default_aead_pack = None
+default_cache_size = 0
+default_cache_ttl = 300
+default_cache_negative_ttl = 30
+default_key_cache_size = 0
+default_key_cache_ttl = 0
+default_log_queue_size = 10000
+default_log_success_sample = 1
+default_log_error_burst = 10
+default_log_error_window = 60
+default_workers = 1
+default_threads = 8
+default_keepalive_timeout = 5
+worker_min_uptime = 10
+worker_max_restart_delay = 60
 
 valid_input_from_key = re.compile('^[cbdefghijklnrtuv]{32,48}$')
+valid_input_public_id = re.compile('^[cbdefghijklnrtuv]{1,16}$')
 
-stats = { 'ok': 0,
-    'invalid': 0,
-    'no_aead': 0,
-    'err': 0 }
+stats = ksm_stats.KSMStats()
+
+# Shared with all forked workers, see aead_cache.InvalidationLog.
+cache_invalidations = aead_cache.InvalidationLog()
+
+def count_stat(name):
+    """ Increment counter `name' in the current stats. """
+    stats.inc(name)
+
+def observe_stat(stage, seconds):
+    """ Record the duration of a request stage in the current stats. """
+    stats.observe(stage, seconds)
+
+# Replaced in main() with one configured from the command line.
+log_pipeline = ksm_log.LogPipeline(count = count_stat)
 
 context = daemon.DaemonContext()
 
@@ -87,14 +127,58 @@ class YHSM_KSMRequestHandler(http.server.BaseHTTPRequestHandler):
         self.hsm = hsm
         self.verbose = args.debug or args.verbose
         self.serve_url = args.serve_url
+        self.batch_url = args.batch_url
+        self.batch_max = args.batch_max
         self.stats_url = args.stats_url
+        self.cache_url = args.cache_invalidate_url
         self.key_handles = args.key_handles
         self.timeout = args.reqtimeout
         self.aead_backend = aead_backend
         self.proxy_ips = args.proxies
-        self.protocol_version = "HTTP/1.0"
+        if args.threads:
+            # HTTP/1.1 lets validation servers keep their connection open between
+            # OTPs. Idle kept-alive connections are watched by the server (see
+            # handle()), which needs its thread pool, so without one stay on
+            # HTTP/1.0 (one request per connection).
+            self.protocol_version = "HTTP/1.1"
+        # Headers and body are written separately; without TCP_NODELAY the body
+        # of a kept-alive response waits for the client's delayed ACK (~40 ms).
+        self.disable_nagle_algorithm = True
         http.server.BaseHTTPRequestHandler.__init__(self, *other_args, **kwargs)
 
+    # Set when the connection is kept alive and handed back to the server.
+    parked = False
+
+    def handle(self):
+        """
+        Handle a single request.
+
+        Unlike BaseHTTPRequestHandler, this does not wait in this thread for
+        the next request on a kept-alive connection : it sets `parked' and
+        YHSM_KSMServer calls handle() again, from any pool thread, once the
+        next request arrives.
+        """
+        self.parked = False
+        self.close_connection = True
+        self.handle_one_request()
+        if not self.close_connection:
+            self.parked = True
+
+    def finish(self):
+        if not self.parked:
+            http.server.BaseHTTPRequestHandler.finish(self)
+
+    def pending_input(self):
+        """ Return True if (part of) the next request has already been received. """
+        try:
+            self.connection.settimeout(0)
+            try:
+                return bool(self.rfile.peek(1))
+            finally:
+                self.connection.settimeout(self.timeout)
+        except OSError:
+            return False
+
     def do_GET(self):
         """ Handle a HTTP GET request. """
         # Example session:
@@ -107,17 +191,53 @@ class YHSM_KSMRequestHandler(http.server.BaseHTTPRequestHandler):
             code = 200
             message = bytes(self.decrypt_yubikey_otp(from_key), encoding="utf-8")
             
+            start = time.perf_counter()
             self.send_response_only(code)
-            self.send_header('Connection', 'close')
+            if self.close_connection:
+                self.send_header('Connection', 'close')
 
             self.send_header("Content-Type", "text/html")
             self.send_header('Content-Length', str(len(message)))
             self.end_headers()
 
             self.wfile.write(message)
+            observe_stat('write', time.perf_counter() - start)
+
+        elif self.stats_url and self.path == self.stats_url:
+            message = bytes(stats.prometheus(), encoding="utf-8")
+
+            self.send_response_only(200)
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header('Content-Length', str(len(message)))
+            self.end_headers()
+
+            self.wfile.write(message)
+
+        elif self.cache_url and self.path.startswith(self.cache_url):
+            public_id = self.path[len(self.cache_url):]
+            if public_id and not re.match(valid_input_public_id, public_id):
+                message = b"ERR Invalid public_id"
+            else:
+                # an empty public_id invalidates all cached AEADs
+                cache_invalidations.invalidate(public_id)
+                self.log_message("Invalidated cached AEAD for public_id '%s'", public_id)
+                message = b"OK"
+
+            self.send_response_only(200)
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+
+            self.send_header("Content-Type", "text/plain")
+            self.send_header('Content-Length', str(len(message)))
+            self.end_headers()
+
+            self.wfile.write(message)
 
         else:
-            self.log_error("Bad URL '{}' - I'm serving '{}' (responding 403)".format(self.path, self.serve_url))
+            self.log_error("Bad URL '%s' - I'm serving '%s' (responding 403)", self.path, self.serve_url)
             code = 403
             message = b"Forbidden"
 
@@ -129,8 +249,61 @@ class YHSM_KSMRequestHandler(http.server.BaseHTTPRequestHandler):
             self.end_headers()
 
             self.wfile.write(message)
-        
-        self.close_connection = 1
+
+            self.close_connection = True
+
+    def do_POST(self):
+        """ Handle a HTTP POST request. """
+        # Example session:
+        # in  : POST /wsapi/decrypt_batch HTTP/1.1
+        #       Content-Length: 86
+        #
+        #       ftftftccccdvvbfcfduvvcubikngtchlubtutucrld
+        #       ftftftcccccccccccccccccccccccccccccccccccc
+        # out : OK counter=0004 low=f585 high=3e use=03
+        #       ERR Unknown public_id
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            length = -1
+        # up to 48 modhex characters and a CRLF per OTP
+        max_length = self.batch_max * 50
+        from_keys = None
+        if self.path == self.batch_url and 0 <= length <= max_length:
+            from_keys = self.rfile.read(length).decode('ascii', 'replace').split()
+            if len(from_keys) > self.batch_max:
+                from_keys = None
+        if from_keys is None:
+            self.log_error("Bad batch request '%s' (Content-Length %d, max %d OTPs) - I'm serving '%s' (responding 403)",
+                           self.path, length, self.batch_max, self.batch_url)
+            message = b"Forbidden"
+
+            self.send_response(403)
+            self.send_header('Connection', 'close')
+
+            self.send_header("Content-Type", self.error_content_type)
+            self.send_header('Content-Length', str(len(message)))
+            self.end_headers()
+
+            self.wfile.write(message)
+
+            self.close_connection = True
+            return
+
+        message = bytes("".join(["{}\n".format(res) for res in self.decrypt_yubikey_otps(from_keys)]),
+                        encoding="utf-8")
+
+        start = time.perf_counter()
+        self.send_response_only(200)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+
+        self.send_header("Content-Type", "text/plain")
+        self.send_header('Content-Length', str(len(message)))
+        self.end_headers()
+
+        self.wfile.write(message)
+        observe_stat('write', time.perf_counter() - start)
 
     def decrypt_yubikey_otp(self, from_key):
         """
@@ -144,44 +317,136 @@ class YHSM_KSMRequestHandler(http.server.BaseHTTPRequestHandler):
 
         on YubiHSM errors (or bad OTP), only 'ERR' is returned.
         """
-        if not re.match(valid_input_from_key, from_key):
-            self.log_error("IN: {}, Invalid OTP".format(from_key))
-            if self.stats_url:
-                stats['invalid'] += 1
+        start = time.perf_counter()
+        public_id = self.check_input(from_key)
+        checked = time.perf_counter()
+        observe_stat('input', checked - start)
+        if public_id is None:
             return "ERR Invalid OTP"
 
-        public_id, _otp = yubikey.split_id_otp(from_key)
-
         aead = ""
         try:
             aead = self.aead_backend.load_aead(public_id)
         except Exception as e:
-            self.log_error(str(e))
+            observe_stat('load_aead', time.perf_counter() - checked)
+            self.log_error("Unknown public_id %s : %s", public_id, error_reason(e))
+            stats.inc('no_aead')
             return "ERR Unknown public_id"
+        loaded = time.perf_counter()
+        observe_stat('load_aead', loaded - checked)
 
         try:
-
             res = yubikey.validate_yubikey_with_aead(self.hsm, from_key, aead, aead.key_handle)
-            # XXX double-check public_id in res, in case BaseHTTPServer suddenly becomes multi-threaded
+        except ksmexception.YHSM_Error as e:
+            res = e
+        observe_stat('validate', time.perf_counter() - loaded)
+
+        return self.format_result(from_key, public_id, aead, res)
+
+    def decrypt_yubikey_otps(self, from_keys):
+        """
+        Try to decrypt a batch of YubiKey OTPs.
+
+        The AEADs of all distinct public ids are fetched from the backend at once,
+        and the OTPs are then validated grouped by key handle.
+
+        Returns a list with one string per OTP in `from_keys', formatted like the
+        result of decrypt_yubikey_otp.
+        """
+        res = [None] * len(from_keys)
+        public_ids = {}
+        for i, from_key in enumerate(from_keys):
+            public_id = self.check_input(from_key)
+            if public_id is None:
+                res[i] = "ERR Invalid OTP"
+            else:
+                public_ids[i] = public_id
+
+        aeads = {}
+        if public_ids:
+            start = time.perf_counter()
+            try:
+                aeads = self.aead_backend.load_aeads(set(public_ids.values()))
+            except Exception as e:
+                self.log_error("Loading AEADs for batch failed : %s", error_reason(e))
+            observe_stat('batch_load_aeads', time.perf_counter() - start)
+
+        by_key_handle = {}
+        for i, public_id in public_ids.items():
+            aead = aeads.get(public_id)
+            if aead is None:
+                self.log_error("Unknown public_id %s : %s", public_id, "No AEAD found")
+                stats.inc('no_aead')
+                res[i] = "ERR Unknown public_id"
+            else:
+                by_key_handle.setdefault(aead.key_handle, []).append(i)
+
+        for key_handle, indexes in by_key_handle.items():
+            otps = [(from_keys[i], aeads[public_ids[i]]) for i in indexes]
+            start = time.perf_counter()
+            try:
+                results = yubikey.validate_yubikeys_with_aead(self.hsm, otps, key_handle)
+            except ksmexception.YHSM_Error as e:
+                results = [e] * len(otps)
+            observe_stat('batch_validate', time.perf_counter() - start)
+            for i, this in zip(indexes, results):
+                res[i] = self.format_result(from_keys[i], public_ids[i], aeads[public_ids[i]], this)
+
+        return res
+
+    def check_input(self, from_key):
+        """
+        Validate the format of an OTP. Returns the public id, or None for invalid input.
+        """
+        if not re.match(valid_input_from_key, from_key):
+            self.log_error("IN: %s, Invalid OTP", from_key, limit_key = from_key[:-32])
+            stats.inc('invalid')
+            return None
+
+        public_id, _otp = yubikey.split_id_otp(from_key)
+        return public_id
+
+    def format_result(self, from_key, public_id, aead, res):
+        """
+        Turn the validation result `res' (or the YHSM_Error raised) into a response line.
+        """
+        try:
+            if isinstance(res, ksmexception.YHSM_Error):
+                raise res
+            # Requests may be handled concurrently (--threads), make sure the
+            # result really is for the AEAD loaded for this request.
+            if res.public_id != expected_nonce(aead, public_id):
+                raise ksmexception.YHSM_Error("Validation result for wrong public_id {}".format(res.public_id.hex()))
             # XXX fix use vs session counter confusion
             val_res = "OK counter={:04x} low={:04x} high={:02x} use={:02x}".format(res.use_ctr, res.ts_low, res.ts_high, res.session_ctr)
-            self.log_message("SUCCESS OTP i %s PT hsm %s", from_key, val_res)
+            self.log_success("SUCCESS OTP i %s PT hsm %s", from_key, val_res)
+            stats.inc('ok')
 
         except ksmexception.YHSM_Error as e:
-            self.log_error ("IN: %s, Validate FAILED: %s" % (from_key, str(e)))
+            self.log_error("IN: %s, Validate FAILED: %s", from_key, error_reason(e),
+                           limit_key = (public_id, e.__class__.__name__, error_reason(e)))
             val_res = "ERR"
+            stats.inc('err')
 
         return val_res
 
-    def log_error(self, fmt):
-        """ Log to syslog. """
-        msg = self.my_address_string() + " - - " + fmt
-        my_log_message(self.verbose, syslog.LOG_ERR, msg)
+    def log_error(self, fmt, *fmt_args, limit_key = None):
+        """
+        Log to syslog. Repeated errors with the same `fmt' and `limit_key'
+        (by default `fmt_args') are rate limited, whatever client they are for.
+        """
+        if limit_key is None:
+            limit_key = tuple([error_reason(arg) for arg in fmt_args])
+        log_pipeline.log(self.verbose, syslog.LOG_ERR, "%s - - " + fmt, self.my_address_string(), *fmt_args,
+                         limit_key = limit_key)
 
     def log_message(self, fmt, *fmt_args):
         """ Log to syslog. """
-        msg = self.my_address_string() + " - - " + fmt % fmt_args
-        my_log_message(self.verbose, syslog.LOG_INFO, msg)
+        log_pipeline.log(self.verbose, syslog.LOG_INFO, "%s - - " + fmt, self.my_address_string(), *fmt_args)
+
+    def log_success(self, fmt, *fmt_args):
+        """ Log to syslog, subject to --log-success-sample. """
+        log_pipeline.log_success(self.verbose, syslog.LOG_INFO, "%s - - " + fmt, self.my_address_string(), *fmt_args)
 
     def my_address_string(self):
         """ For logging client host without resolving. """
@@ -189,9 +454,28 @@ class YHSM_KSMRequestHandler(http.server.BaseHTTPRequestHandler):
 
         # If listed in proxy_ips, use the X-Forwarded-For header, if present.
         if addr in self.proxy_ips:
-            return self.headers.getheader('x-forwarded-for', addr)
+            return self.headers.get('x-forwarded-for', addr)
         return addr
 
+def error_reason(e):
+    """
+    Return the explanation of an error for logging. str() of a YHSM_Error
+    includes the address of the exception object.
+    """
+    if isinstance(e, ksmexception.YHSM_Error):
+        return e.reason
+    return str(e)
+
+def expected_nonce(aead, public_id):
+    """
+    Return the (padded) nonce a validation of an OTP from `public_id' using
+    `aead' must report as public_id.
+    """
+    nonce = aead.nonce
+    if not nonce:
+        nonce = bytes.fromhex(yubikey.modhex_decode(public_id))
+    return util.input_validate_nonce(nonce, pad = True)
+
 def aead_filename(aead_dir, key_handle, public_id):
     """
     Return the filename of the AEAD for this public_id.
@@ -201,30 +485,79 @@ def aead_filename(aead_dir, key_handle, public_id):
 
 class FSBackend(object):
 
-    def __init__(self, aead_dir, key_handles):
+    def __init__(self, aead_dir, key_handles, count = None):
         self.aead_dir = aead_dir
         self.key_handles = key_handles
+        # called with ('fs_miss', key_handle) for AEAD files not found
+        self._count = count if count is not None else (lambda name: None)
         if not os.path.isdir(aead_dir):
             raise ValueError("AEAD directory '{}' does not exist.".format(aead_dir))
 
     def load_aead(self, public_id):
         fn_list = []
         for kh, kh_int in self.key_handles:
-            aead = aead_cmd.YHSM_GeneratedAEAD(None, kh_int, '')
             filename = aead_filename(self.aead_dir, kh, public_id)
             fn_list.append(filename)
             try:
-                aead.load(filename)
-                if not aead.nonce:
-                    aead.nonce = yubikey.modhex_decode(public_id).decode('hex')
-                return aead
+                return self._load_file(filename, kh_int, public_id)
             except IOError:
+                self._count(('fs_miss', kh))
                 continue
-        raise Exception("Attempted to load AEAD from : {}".format(fn_list))
+        raise ksmexception.YHSM_AEADNotFound(public_id, "Attempted to load AEAD from : {}".format(fn_list))
+
+    def load_aeads(self, public_ids):
+        """
+        Load the AEADs for many public ids. Returns a dict keyed by public id,
+        public ids without an AEAD are left out.
+
+        The AEAD files are simply opened one by one, key handle by key handle.
+        aead_filename() gives every public id a directory of its own, so there
+        is no directory listing or lookup to share between public ids.
+        """
+        res = {}
+        todo = set(public_ids)
+        for kh, kh_int in self.key_handles:
+            if not todo:
+                break
+            for public_id in todo:
+                try:
+                    res[public_id] = self._load_file(aead_filename(self.aead_dir, kh, public_id),
+                                                     kh_int, public_id)
+                except IOError:
+                    self._count(('fs_miss', kh))
+            todo.difference_update(res)
+        return res
+
+    def all_aeads(self, key_handle):
+        """
+        Yield (public_id, aead) for all AEADs stored for key handle `key_handle'
+        (as given on the command line).
+        """
+        kh_int = util.key_handle_to_int(key_handle)
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.aead_dir, key_handle)):
+            dirnames.sort()
+            for public_id in sorted(filenames):
+                if not re.match(valid_input_public_id, public_id):
+                    continue
+                yield public_id, self._load_file(os.path.join(dirpath, public_id), kh_int, public_id)
+
+    def _load_file(self, filename, kh_int, public_id):
+        aead = aead_cmd.YHSM_GeneratedAEAD(None, kh_int, '')
+        aead.load(filename)
+        if not aead.nonce:
+            aead.nonce = bytes.fromhex(yubikey.modhex_decode(public_id))
+        return aead
+
+    def close(self):
+        pass
 
 class SQLBackend(object):
-    def __init__(self, db_url):
+    def __init__(self, db_url, count = None):
         self.engine = sqlalchemy.create_engine(db_url, pool_pre_ping=True)
+        if count is not None:
+            # the difference is the number of connections checked out of the pool
+            sqlalchemy.event.listen(self.engine, 'checkout', lambda *args: count('sql_pool_checkout'))
+            sqlalchemy.event.listen(self.engine, 'checkin', lambda *args: count('sql_pool_checkin'))
         metadata = sqlalchemy.MetaData()
         self.aead_table = sqlalchemy.Table('aead_table', metadata, autoload=True, autoload_with=self.engine)
 
@@ -232,38 +565,340 @@ class SQLBackend(object):
         """ Loads AEAD from the specified database. """
         connection = self.engine.connect()
         trans = connection.begin()
+        aead_ = None
 
         try:
             s = sqlalchemy.select([self.aead_table]).where(self.aead_table.c.public_id == public_id)
             result = connection.execute(s)
             for row in result:
-                kh_int = row['keyhandle']
-                aead_ = aead_cmd.YHSM_GeneratedAEAD(None, kh_int, '')
-                #Benjamin
-                if(type(row['aead']) == string):
-                    aead_.data = bytes(row['aead'], encoding="utf-8")
-                else:
-                    aead_.data = row['aead']
-                aead_.nonce = bytes([ ord(c) for c in row['nonce'] ])
-                # aead_.nonce = bytes(row['nonce'], encoding="utf-8") // Good way but not compatible with old version
-            return aead_
+                aead_ = self._row_to_aead(row)
 
         except Exception as e:
             trans.rollback()
             #my_log_message(True, syslog.LOG_INFO, str(e))
-            raise Exception("No AEAD in DB for public_id %s (%s)" % (public_id, "nothing"))
+            raise Exception("Could not load AEAD from DB for public_id %s (%s)" % (public_id, e))
         finally:
             connection.close()
 
+        if aead_ is None:
+            raise ksmexception.YHSM_AEADNotFound(public_id, "No AEAD in DB for public_id %s" % (public_id))
+        return aead_
+
+    def load_aeads(self, public_ids):
+        """
+        Load the AEADs for many public ids using a single query. Returns a dict
+        keyed by public id, public ids without an AEAD are left out.
+        """
+        res = {}
+        public_ids = list(public_ids)
+        if not public_ids:
+            return res
+        connection = self.engine.connect()
+        trans = connection.begin()
+
+        try:
+            s = sqlalchemy.select([self.aead_table]).where(self.aead_table.c.public_id.in_(public_ids))
+            for row in connection.execute(s):
+                res[row['public_id']] = self._row_to_aead(row)
+            return res
+
+        except Exception as e:
+            trans.rollback()
+            raise Exception("Could not load AEADs from DB for {} public_ids ({})".format(len(public_ids), e))
+        finally:
+            connection.close()
+
+    def all_aeads(self, key_handle):
+        """
+        Yield (public_id, aead) for all AEADs in the database encrypted with
+        key handle `key_handle' (as given on the command line).
+        """
+        kh_int = util.key_handle_to_int(key_handle)
+        connection = self.engine.connect()
+        try:
+            s = sqlalchemy.select([self.aead_table]).where(self.aead_table.c.keyhandle == kh_int)
+            for row in connection.execute(s):
+                yield row['public_id'], self._row_to_aead(row)
+        finally:
+            connection.close()
+
+    def _row_to_aead(self, row):
+        kh_int = row['keyhandle']
+        aead_ = aead_cmd.YHSM_GeneratedAEAD(None, kh_int, '')
+        #Benjamin
+        if(type(row['aead']) == string):
+            aead_.data = bytes(row['aead'], encoding="utf-8")
+        else:
+            aead_.data = row['aead']
+        aead_.nonce = bytes([ ord(c) for c in row['nonce'] ])
+        # aead_.nonce = bytes(row['nonce'], encoding="utf-8") // Good way but not compatible with old version
+        return aead_
+
+    def close(self):
+        """ Drop all pooled connections, e.g. before forking workers. """
+        self.engine.dispose()
+
+class PackBackend(object):
+    """
+    AEADs stored in one memory mapped pack file per key handle, see aead_pack.
+
+    A pack replaced by renaming a new file over it is picked up within
+    `check_interval' seconds.
+    """
+
+    def __init__(self, pack_dir, key_handles, check_interval = 1, count = None):
+        self.pack_dir = pack_dir
+        self.key_handles = key_handles
+        # called with ('fs_miss', key_handle) for public ids not in a pack
+        self._count = count if count is not None else (lambda name: None)
+        self.check_interval = check_interval
+        if not os.path.isdir(pack_dir):
+            raise ValueError("AEAD pack directory '{}' does not exist.".format(pack_dir))
+        self._packs = [None] * len(key_handles)
+        self._next_check = 0
+        self._lock = threading.Lock()
+        self._check()
+        if not [pack for pack in self._packs if pack is not None]:
+            raise ValueError("No AEAD packs for key handle(s) {} in '{}'.".format(
+                [kh for kh, _ in key_handles], pack_dir))
+
+    def load_aead(self, public_id):
+        for (kh, _), pack in zip(self.key_handles, self._current()):
+            if pack is None:
+                continue
+            aead = pack.lookup(public_id)
+            if aead is not None:
+                return aead
+            self._count(('fs_miss', kh))
+        raise ksmexception.YHSM_AEADNotFound(public_id, "No AEAD for public_id {} in packs in '{}'".format(
+            public_id, self.pack_dir))
+
+    def load_aeads(self, public_ids):
+        res = {}
+        packs = [(kh, pack) for ((kh, _), pack) in zip(self.key_handles, self._current()) if pack is not None]
+        for public_id in public_ids:
+            for kh, pack in packs:
+                aead = pack.lookup(public_id)
+                if aead is not None:
+                    res[public_id] = aead
+                    break
+                self._count(('fs_miss', kh))
+        return res
+
+    def close(self):
+        # The mappings are released when the last lookup using them is done.
+        self._packs = [None] * len(self.key_handles)
+
+    def _current(self):
+        if time.monotonic() >= self._next_check:
+            self._check()
+        return self._packs
+
+    def _check(self):
+        """ (Re)open packs that have been created or replaced since we last looked. """
+        with self._lock:
+            if time.monotonic() < self._next_check:
+                return
+            packs = list(self._packs)
+            for i, (kh, kh_int) in enumerate(self.key_handles):
+                filename = aead_pack.aead_pack_filename(self.pack_dir, kh)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    packs[i] = None
+                    continue
+                if packs[i] is not None and packs[i].identity == (st.st_dev, st.st_ino, st.st_mtime_ns):
+                    continue
+                try:
+                    packs[i] = aead_pack.AEADPack(filename)
+                except Exception as e:
+                    my_log_message(True, syslog.LOG_ERR, "Could not load AEAD pack '{}' : {}".format(filename, e))
+            self._packs = packs
+            self._next_check = time.monotonic() + self.check_interval
+
+def setup_hsm(hsm, args):
+    """
+    Apply the command line options for the (soft) YubiHSM to hsm.
+    """
+    if args.key_cache_size:
+        hsm.enable_key_cache(args.key_cache_size,
+                             ttl = args.key_cache_ttl,
+                             count = count_stat)
+    return hsm
+
+def new_aead_backend(args):
+    """
+    Create the AEAD backend selected by the command line arguments.
+    """
+    if args.db_url:
+        # Using an SQL database for AEADs
+        backend = SQLBackend(args.db_url, count = count_stat)
+    elif args.aead_pack:
+        # Using packed AEAD files
+        backend = PackBackend(args.aead_pack, args.key_handles, count = count_stat)
+    else:
+        # Using the filesystem for AEADs
+        backend = FSBackend(args.aead_dir, args.key_handles, count = count_stat)
+    if args.cache_size:
+        backend = aead_cache.CachingBackend(backend, args.cache_size,
+                                            ttl = args.cache_ttl,
+                                            negative_ttl = args.cache_negative_ttl,
+                                            invalidations = cache_invalidations,
+                                            count = count_stat)
+    return backend
+
+class _IdleConnections():
+    """
+    Kept-alive connections waiting for their next request, all watched by a
+    single thread. A connection that becomes readable is handed to the
+    server's thread pool again, one that stays idle for `timeout' seconds
+    is closed.
+    """
+
+    def __init__(self, server, timeout):
+        self.server = server
+        self.timeout = timeout
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._added = collections.deque()
+        # handler -> deadline, in order of deadline
+        self._deadlines = collections.OrderedDict()
+        self._thread = threading.Thread(target = self._run, name = 'ksm-keepalive')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, handler):
+        """ Watch the connection of a parked request handler. """
+        self._added.append(handler)
+        try:
+            self._wakeup_w.send(b'\x00')
+        except OSError:
+            # wakeup already pending
+            pass
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._added:
+                handler = self._added.popleft()
+                try:
+                    self._selector.register(handler.connection, selectors.EVENT_READ, handler)
+                except (OSError, ValueError):
+                    # connection already gone
+                    self.server.close_parked(handler)
+                    continue
+                self._deadlines[handler] = now + self.timeout
+
+            timeout = None
+            if self._deadlines:
+                timeout = max(next(iter(self._deadlines.values())) - now, 0)
+            for key, _ in self._selector.select(timeout):
+                handler = key.data
+                if handler is None:
+                    try:
+                        self._wakeup_r.recv(4096)
+                    except OSError:
+                        pass
+                    continue
+                self._forget(handler)
+                self.server.resume_request(handler)
+
+            now = time.monotonic()
+            while self._deadlines:
+                handler, deadline = next(iter(self._deadlines.items()))
+                if deadline > now:
+                    break
+                self._forget(handler)
+                self.server.close_parked(handler)
+
+    def _forget(self, handler):
+        self._selector.unregister(handler.connection)
+        del self._deadlines[handler]
+
 class YHSM_KSMServer(http.server.HTTPServer):
     """
     Wrapper class to properly initialize address_family for IPv6 addresses.
+
+    If `threads' is non-zero, connections are handled by a pool of that many
+    threads instead of in the thread accepting them. A pool thread only
+    handles one request at a time : between requests, kept-alive connections
+    wait without a thread (see _IdleConnections), for up to
+    `keepalive_timeout' seconds.
     """
-    def __init__(self, server_address, req_handler):
+
+    request_queue_size = 128
+
+    def __init__(self, server_address, req_handler, threads = 0, keepalive_timeout = default_keepalive_timeout):
         if ":" in server_address[0]:
             self.address_family = socket.AF_INET6
+        self.threads = threads
+        self.keepalive_timeout = keepalive_timeout
+        self._pool = None
+        self._idle = None
         http.server.HTTPServer.__init__(self, server_address, req_handler)
 
+    def process_request(self, request, client_address):
+        if not self.threads:
+            return http.server.HTTPServer.process_request(self, request, client_address)
+        if self._pool is None:
+            # created lazily, threads do not survive fork()
+            self._pool = ThreadPoolExecutor(max_workers = self.threads)
+            self._idle = _IdleConnections(self, self.keepalive_timeout)
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def process_request_thread(self, request, client_address):
+        """ Like socketserver.ThreadingMixIn.process_request_thread, but keeps parked connections. """
+        handler = None
+        try:
+            handler = self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        self._done(handler, request)
+
+    def resume_request(self, handler):
+        """ Handle the next request on a parked connection, in the pool. """
+        self._pool.submit(self._resume_request_thread, handler)
+
+    def _resume_request_thread(self, handler):
+        try:
+            try:
+                handler.handle()
+            finally:
+                handler.finish()
+        except Exception:
+            handler.parked = False
+            self.handle_error(handler.request, handler.client_address)
+        self._done(handler, handler.request)
+
+    def _done(self, handler, request):
+        if handler is None or not getattr(handler, 'parked', False):
+            self.shutdown_request(request)
+        elif handler.pending_input():
+            # pipelined request, queue it behind the other connections
+            self.resume_request(handler)
+        else:
+            self._idle.add(handler)
+
+    def close_parked(self, handler):
+        """ Close a parked connection that stayed idle too long. """
+        handler.parked = False
+        try:
+            handler.finish()
+        except (OSError, ValueError):
+            pass
+        self.shutdown_request(handler.request)
+
+    def server_close(self):
+        http.server.HTTPServer.server_close(self)
+        if self._pool is not None:
+            self._pool.shutdown(wait = False)
+
 def parse_args():
     """
     Parse the command line arguments
@@ -285,6 +920,14 @@ def parse_args():
                         help='AEAD directory - base directory of your AEADs',
                         metavar='DIR',
                         )
+    parser.add_argument('--aead-pack',
+                        dest='aead_pack',
+                        default=default_aead_pack,
+                        required=False,
+                        help='Directory with packed AEAD files (<key handle>.aeadpack) to use '
+                        'instead of the AEAD directory, see build_aead_pack.py',
+                        metavar='DIR',
+                        )
     parser.add_argument('-U', '--serve-url',
                         dest='serve_url',
                         default=default_serve_url,
@@ -292,12 +935,71 @@ def parse_args():
                         help='Base URL for decrypt web service',
                         metavar='URL',
                         )
+    parser.add_argument('--batch-url',
+                        dest='batch_url',
+                        default=default_batch_url,
+                        required=False,
+                        help='URL for decrypting a batch of newline separated OTPs POSTed to it',
+                        metavar='URL',
+                        )
+    parser.add_argument('--batch-max',
+                        dest='batch_max',
+                        type=int, default=default_batch_max,
+                        required=False,
+                        help='Maximum number of OTPs in one batch request',
+                        metavar='NUM',
+                        )
     parser.add_argument('-S', '--stats-url',
                         dest='stats_url',
                         required=False,
-                        help='URL where statistics can be retrieved',
+                        help='URL where statistics can be retrieved (Prometheus text format)',
+                        metavar='URL',
+                        )
+    parser.add_argument('--cache-size',
+                        dest='cache_size',
+                        type=int, default=default_cache_size,
+                        required=False,
+                        help='Number of public ids to cache AEADs for (0 disables the cache)',
+                        metavar='NUM',
+                        )
+    parser.add_argument('--cache-ttl',
+                        dest='cache_ttl',
+                        type=int, default=default_cache_ttl,
+                        required=False,
+                        help='Seconds to cache AEADs (0 caches them until evicted)',
+                        metavar='SECONDS',
+                        )
+    parser.add_argument('--cache-negative-ttl',
+                        dest='cache_negative_ttl',
+                        type=int, default=default_cache_negative_ttl,
+                        required=False,
+                        help='Seconds to remember unknown public ids (0 disables)',
+                        metavar='SECONDS',
+                        )
+    parser.add_argument('--cache-invalidate-url',
+                        dest='cache_invalidate_url',
+                        required=False,
+                        help='Base URL for invalidating the cached AEAD of the public id '
+                        'appended to it (all cached AEADs if none). SIGHUP invalidates all cached AEADs too.',
                         metavar='URL',
                         )
+    parser.add_argument('--key-cache-size',
+                        dest='key_cache_size',
+                        type=int, default=default_key_cache_size,
+                        required=False,
+                        help='Maximum number of entries (YubiKey AES keys unwrapped from AEADs) '
+                        'to keep in memory, an entry count rather than a byte limit. '
+                        'Cached keys are not wiped from memory when dropped '
+                        '(0 disables the key cache)',
+                        metavar='NUM',
+                        )
+    parser.add_argument('--key-cache-ttl',
+                        dest='key_cache_ttl',
+                        type=int, default=default_key_cache_ttl,
+                        required=False,
+                        help='Seconds to keep unwrapped YubiKey AES keys (0 keeps them until evicted)',
+                        metavar='SECONDS',
+                        )
     parser.add_argument('-v', '--verbose',
                         dest='verbose',
                         action='store_true', default=False,
@@ -310,7 +1012,7 @@ def parse_args():
                         )
     parser.add_argument('--debug',
                         dest='debug',
-                        action='store_true', default=True,
+                        action='store_true', default=False,
                         help='Enable debug operation'
                         )
     parser.add_argument('--port',
@@ -366,6 +1068,61 @@ def parse_args():
                         'X-Forwarded-For should be used for logging purposes.',
                         metavar='IP',
                         )
+    parser.add_argument('--log-queue-size',
+                        dest='log_queue_size',
+                        type=int, default=default_log_queue_size,
+                        required=False,
+                        help='Maximum number of log records waiting to be written, more are dropped',
+                        metavar='NUM',
+                        )
+    parser.add_argument('--log-success-sample',
+                        dest='log_success_sample',
+                        type=int, default=default_log_success_sample,
+                        required=False,
+                        help='Log one in NUM successfully decrypted OTPs (0 logs none)',
+                        metavar='NUM',
+                        )
+    parser.add_argument('--log-error-burst',
+                        dest='log_error_burst',
+                        type=int, default=default_log_error_burst,
+                        required=False,
+                        help='Number of identical errors logged per rate limit window',
+                        metavar='NUM',
+                        )
+    parser.add_argument('--log-error-window',
+                        dest='log_error_window',
+                        type=int, default=default_log_error_window,
+                        required=False,
+                        help='Length of the error rate limit window (0 disables rate limiting)',
+                        metavar='SECONDS',
+                        )
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int, default=default_workers,
+                        required=False,
+                        help='Number of pre-forked worker processes sharing the listening socket',
+                        metavar='NUM',
+                        )
+    parser.add_argument('--threads',
+                        dest='threads',
+                        type=int, default=default_threads,
+                        required=False,
+                        help='Size of the request handling thread pool in each worker, i.e. the '
+                        'number of requests handled at the same time. Connections are kept alive '
+                        '(HTTP/1.1) only with a pool; between requests they wait without holding a '
+                        'pool thread (see --keepalive-timeout), and their next request queues '
+                        'behind requests from other connections. 0 handles connections one at a '
+                        'time in the accepting thread, closing each after one request',
+                        metavar='NUM',
+                        )
+    parser.add_argument('--keepalive-timeout',
+                        dest='keepalive_timeout',
+                        type=int, default=default_keepalive_timeout,
+                        required=False,
+                        help='Seconds a kept-alive connection may stay idle between requests before '
+                        'it is closed (--reqtimeout applies while a request is being read)',
+                        metavar='SECONDS',
+                        )
 
     return parser.parse_args()
 
@@ -388,6 +1145,17 @@ def args_fixup(args):
         if env_var in os.environ:
             args.db_url = os.environ[env_var]
 
+    if args.workers < 1:
+        args.workers = 1
+    if args.cache_size < 0:
+        args.cache_size = 0
+    if args.key_cache_size < 0:
+        args.key_cache_size = 0
+    if args.threads < 0:
+        args.threads = 0
+    if args.keepalive_timeout < 0:
+        args.keepalive_timeout = 0
+
 
 def write_pid_file(fn):
     """ Create a file with our PID. """
@@ -404,25 +1172,137 @@ def write_pid_file(fn):
 def run(hsm, aead_backend, args):
     """
     Start a BaseHTTPServer.HTTPServer and serve requests forever.
+
+    With more than one worker, the listening socket is created here and
+    inherited by args.workers forked processes, each of which uses its own
+    AEAD backend and SoftYHSM.
     """
+    global stats
 
     write_pid_file(args.pid_file)
 
+    fs_key_handles = [] if args.db_url else [kh for kh, _ in args.key_handles]
+    stats = ksm_stats.KSMStats(args.workers, fs_key_handles)
+
+    # Invalidate all cached AEADs on SIGHUP, e.g. after re-keying tokens.
+    signal.signal(signal.SIGHUP, lambda signum, frame: cache_invalidations.flush_all())
+
     server_address = (args.listen_addr, args.listen_port)
     httpd = YHSM_KSMServer(server_address,
-                           partial(YHSM_KSMRequestHandler, hsm, aead_backend, args))
+                           partial(YHSM_KSMRequestHandler, hsm, aead_backend, args),
+                           threads = args.threads,
+                           keepalive_timeout = args.keepalive_timeout)
     my_log_message(args.debug or args.verbose, syslog.LOG_INFO,
-                   "Serving requests to 'http://{}:{}{}' with key handle(s) {} (YubiHSM: '{}', AEADs in '{}', DB in '{}')".format(args.listen_addr, args.listen_port, args.serve_url, args.key_handles, args.device, args.aead_dir, args.db_url))
-    httpd.serve_forever()
+                   "Serving requests to 'http://{}:{}{}' with key handle(s) {} (YubiHSM: '{}', AEADs in '{}', AEAD packs in '{}', DB in '{}')".format(args.listen_addr, args.listen_port, args.serve_url, args.key_handles, args.device, args.aead_dir, args.aead_pack, args.db_url))
+    if args.workers > 1:
+        run_workers(httpd, hsm, aead_backend, args)
+    else:
+        # e.g. from `docker stop', exit through main() to flush the log queue
+        signal.signal(signal.SIGTERM, exit_on_signal)
+        httpd.serve_forever()
+
+
+def run_workers(httpd, hsm, aead_backend, args):
+    """
+    Fork args.workers processes serving requests from httpd's socket, and
+    restart any of them that dies until we are told to stop.
+
+    A worker that dies within worker_min_uptime seconds of being started
+    (e.g. because the database is unreachable) is restarted after a delay,
+    doubling with every such failure up to worker_max_restart_delay.
+    """
+    # Don't let the workers inherit pooled database connections.
+    aead_backend.close()
+    # A worker that loses the race for a new connection must not block in accept().
+    httpd.socket.setblocking(False)
+
+    children = {}
+    started = {}
+    delays = {}
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker in range(args.workers):
+        children[start_worker(httpd, hsm, args, worker)] = worker
+        started[worker] = time.monotonic()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            break
+        worker = children.pop(pid, None)
+        if worker is None or stopping:
+            continue
+        if time.monotonic() - started[worker] < worker_min_uptime:
+            delay = min(delays.get(worker, 0.5) * 2, worker_max_restart_delay)
+        else:
+            delay = 0
+        delays[worker] = delay
+        my_log_message(args.debug or args.verbose, syslog.LOG_ERR,
+                       "Worker {} (pid {}) exited with status {}, restarting in {:g} seconds".format(
+                           worker, pid, status, delay))
+        deadline = time.monotonic() + delay
+        while not stopping and time.monotonic() < deadline:
+            time.sleep(max(min(deadline - time.monotonic(), 0.5), 0))
+        if stopping:
+            continue
+        children[start_worker(httpd, hsm, args, worker)] = worker
+        started[worker] = time.monotonic()
+
+    httpd.server_close()
+
+
+def start_worker(httpd, hsm, args, worker):
+    """
+    Fork a worker process serving requests from httpd. Returns the pid in the parent.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+
+    status = 0
+    try:
+        # exit through the finally: below, flushing the log queue
+        signal.signal(signal.SIGTERM, exit_on_signal)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        stats.set_worker(worker)
+        worker_hsm = setup_hsm(SoftYHSM(dict(hsm.keys), debug = hsm.debug), args)
+        worker_backend = new_aead_backend(args)
+        httpd.RequestHandlerClass = partial(YHSM_KSMRequestHandler, worker_hsm, worker_backend, args)
+        httpd.serve_forever()
+    except Exception as e:
+        my_log_message(args.debug or args.verbose, syslog.LOG_ERR,
+                       "Worker {} failed : {}".format(worker, e))
+        status = 1
+    finally:
+        # os._exit() skips atexit handlers
+        log_pipeline.flush()
+        os._exit(status)
+
+
+def exit_on_signal(signum, frame):
+    """ Signal handler turning SIGTERM into SystemExit, so that finally: clauses run. """
+    raise SystemExit(128 + signum)
 
 
 def my_log_message(verbose, prio, msg):
     """
-    Log to syslog, and possibly also to stderr.
+    Log to syslog, and possibly also to stderr (through the log pipeline).
     """
-    syslog.syslog(prio, msg)
-    if verbose or prio == syslog.LOG_ERR:
-        sys.stderr.write("{}\n".format(msg))
+    log_pipeline.log(verbose, prio, msg)
 
 
 def main():
@@ -437,24 +1317,29 @@ def main():
     args = parse_args()
     args_fixup(args)
 
+    global log_pipeline
+    log_pipeline = ksm_log.LogPipeline(queue_size = args.log_queue_size,
+                                       success_sample = args.log_success_sample,
+                                       error_burst = args.log_error_burst,
+                                       error_window = args.log_error_window,
+                                       count = count_stat)
+    atexit.register(log_pipeline.flush)
+
     aead_backend = None
 
-    if args.db_url:
-        # Using an SQL database for AEADs
-        try:
-            aead_backend = SQLBackend(args.db_url)
-        except Exception as e:
+    try:
+        aead_backend = new_aead_backend(args)
+    except Exception as e:
+        if args.db_url:
             my_log_message(args.debug or args.verbose, syslog.LOG_ERR,
                            'Could not connect to database "{}" : {}'.format(args.db_url, e))
-            return 1
-    else:
-        # Using the filesystem for AEADs
-        try:
-            aead_backend = FSBackend(args.aead_dir, args.key_handles)
-        except Exception as e:
+        elif args.aead_pack:
+            my_log_message(args.debug or args.verbose, syslog.LOG_ERR,
+                           'Could not create AEAD PackBackend: {}'.format(e))
+        else:
             my_log_message(args.debug or args.verbose, syslog.LOG_ERR,
                            'Could not create AEAD FSBackend: {}'.format(e))
-            return 1
+        return 1
 
     if args.device == '-':
         print("soft")
@@ -475,9 +1360,14 @@ def main():
                            'Failed opening soft YHSM "{}" : {}'.format(args.device, e))
             return 1
 
+    setup_hsm(hsm, args)
+
     if args.daemon:
         with context:
-            run(hsm, aead_backend, args)
+            try:
+                run(hsm, aead_backend, args)
+            finally:
+                log_pipeline.flush()
     else:
         try:
             run(hsm, aead_backend, args)
@@ -485,6 +1375,8 @@ def main():
             print ("")
             print ("Shutting down")
             print ("")
+        finally:
+            log_pipeline.flush()
 
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
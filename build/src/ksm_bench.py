@@ -0,0 +1,525 @@
+"""
+Load generator and benchmarks for the KSM.
+
+Everything is synthetic and self-contained : a keys.json and N YubiKey tokens
+are generated into a work directory, their AEADs are stored as an AEAD
+directory tree, in a SQLite aead_table and as AEAD packs, and valid OTPs are
+minted for the tokens. Then
+
+  - ksm.py is started against each selected backend and driven over HTTP by a
+    configurable number of keep-alive client threads, reporting throughput and
+    p50/p99/p999 latency, and
+  - the hot functions (aesCCM, crc16, modhex_decode, load_aead, ...) are timed
+    in-process.
+
+Results can be written as JSON (--json) and compared with an earlier run
+(--compare).
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shlex
+import shutil
+import socket
+import struct
+import argparse
+import platform
+import tempfile
+import threading
+import itertools
+import subprocess
+import http.client
+import timeit
+
+import sqlalchemy
+from Crypto.Cipher import AES
+
+import aead_cmd
+import aead_pack
+import defines
+import soft_hsm
+import yubikey
+from ksm import FSBackend, SQLBackend, PackBackend, aead_filename, default_serve_url
+
+default_tokens = 1000
+default_requests = 20000
+default_concurrency = 16
+default_warmup = 200
+default_key_handle = 1
+default_public_id_chars = 12
+
+backends = ('fs', 'sql', 'pack')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Benchmark the KSM with synthetic tokens',
+                                     add_help = True,
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter,
+                                     )
+    parser.add_argument('--tokens',
+                        dest='tokens',
+                        type=int, default=default_tokens,
+                        required=False,
+                        help='Number of synthetic YubiKey tokens to generate',
+                        metavar='NUM',
+                        )
+    parser.add_argument('--key-handle',
+                        dest='key_handle',
+                        type=int, default=default_key_handle,
+                        required=False,
+                        help='Key handle of the synthetic keys.json',
+                        metavar='HANDLE',
+                        )
+    parser.add_argument('--backends',
+                        dest='backends',
+                        nargs='+', choices=backends, default=list(backends),
+                        required=False,
+                        help='AEAD backends to run the load test against',
+                        )
+    parser.add_argument('-n', '--requests',
+                        dest='requests',
+                        type=int, default=default_requests,
+                        required=False,
+                        help='Number of OTPs to decrypt per backend (0 skips the load test)',
+                        metavar='NUM',
+                        )
+    parser.add_argument('-c', '--concurrency',
+                        dest='concurrency',
+                        type=int, default=default_concurrency,
+                        required=False,
+                        help='Number of concurrent keep-alive client connections',
+                        metavar='NUM',
+                        )
+    parser.add_argument('--warmup',
+                        dest='warmup',
+                        type=int, default=default_warmup,
+                        required=False,
+                        help='Number of requests sent before measuring',
+                        metavar='NUM',
+                        )
+    parser.add_argument('--no-micro',
+                        dest='micro',
+                        action='store_false', default=True,
+                        help='Skip the micro-benchmarks',
+                        )
+    parser.add_argument('--ksm',
+                        dest='ksm',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ksm.py'),
+                        required=False,
+                        help='The KSM script to benchmark',
+                        metavar='FILENAME',
+                        )
+    parser.add_argument('--ksm-args',
+                        dest='ksm_args',
+                        default='',
+                        required=False,
+                        help='Extra arguments for the KSM, e.g. "--workers 4 --threads 8"',
+                        metavar='ARGS',
+                        )
+    parser.add_argument('--port',
+                        dest='port',
+                        type=int, default=0,
+                        required=False,
+                        help='Port to run the KSM on (0 picks a free port)',
+                        metavar='PORT',
+                        )
+    parser.add_argument('--work-dir',
+                        dest='work_dir',
+                        required=False,
+                        help='Directory for the synthetic keys, AEADs and KSM logs '
+                        '(default: a temporary directory, removed afterwards)',
+                        metavar='DIR',
+                        )
+    parser.add_argument('--json',
+                        dest='json',
+                        required=False,
+                        help='Write the results to this file as JSON',
+                        metavar='FILENAME',
+                        )
+    parser.add_argument('--compare',
+                        dest='compare',
+                        required=False,
+                        help='JSON results of an earlier run to compare with',
+                        metavar='FILENAME',
+                        )
+    parser.add_argument('--seed',
+                        dest='seed',
+                        type=int, default=None,
+                        required=False,
+                        help='Seed for the synthetic OTP fields',
+                        )
+    parser.add_argument('-v', '--verbose',
+                        dest='verbose',
+                        action='store_true', default=False,
+                        help='Enable verbose operation',
+                        )
+    return parser.parse_args()
+
+def args_fixup(args):
+    if args.tokens < 1:
+        sys.stderr.write("Need at least one token, got %d\n" % (args.tokens))
+        sys.exit(1)
+    if args.concurrency < 1:
+        sys.stderr.write("Concurrency must be at least 1, was %d\n" % (args.concurrency))
+        sys.exit(1)
+    if args.requests and not os.path.isfile(args.ksm):
+        sys.stderr.write("KSM '%s' does not exist.\n" % (args.ksm))
+        sys.exit(1)
+
+class SyntheticToken():
+    """ A generated YubiKey : its public id, secrets and AEAD. """
+    def __init__(self, public_id, key, uid, aead):
+        self.public_id = public_id
+        self.key = key
+        self.uid = uid
+        self.aead = aead
+        self._aes = AES.new(key, AES.MODE_ECB)
+
+    def otp(self, counter, use, timestamp, rnd):
+        """
+        Return a valid OTP (modhex, public id included) for these values of
+        the session counter, session use, 24 bit timestamp and random field.
+        """
+        plaintext = self.uid + struct.pack('< H H B B H', counter, timestamp & 0xffff,
+                                           (timestamp >> 16) & 0xff, use, rnd)
+        plaintext += struct.pack('< H', 0xffff - soft_hsm.crc16(plaintext))
+        return self.public_id + yubikey.modhex_encode(self._aes.encrypt(plaintext).hex())
+
+def make_keys(filename, key_handle):
+    """ Write a keys.json with a random AES key for `key_handle', return the SoftYHSM. """
+    keys = {key_handle: os.urandom(16)}
+    with open(filename, 'w') as f:
+        json.dump(dict((str(kh), key.hex()) for (kh, key) in keys.items()), f)
+    return soft_hsm.SoftYHSM(keys)
+
+def make_tokens(hsm, key_handle, count, public_id_chars = default_public_id_chars):
+    """
+    Generate `count' tokens with public ids 1..count, with their AEADs
+    encrypted with `key_handle' the same way generate_keys_bdd does.
+    """
+    tokens = []
+    for int_id in range(1, count + 1):
+        public_id = ("%x" % int_id).rjust(public_id_chars, '0')
+        secret = aead_cmd.YHSM_YubiKeySecret(os.urandom(defines.KEY_SIZE), os.urandom(defines.UID_SIZE))
+        hsm.load_secret(secret)
+        aead = hsm.generate_aead(bytes.fromhex(public_id), key_handle)
+        tokens.append(SyntheticToken(yubikey.modhex_encode(public_id), secret.key, secret.uid, aead))
+    return tokens
+
+def populate_fs(aead_dir, key_handle, tokens):
+    """ Store the AEADs of `tokens' in an AEAD directory tree (see ksm.FSBackend). """
+    for token in tokens:
+        filename = aead_filename(aead_dir, str(key_handle), token.public_id)
+        os.makedirs(os.path.dirname(filename), exist_ok = True)
+        token.aead.save(filename)
+
+def populate_sql(db_url, tokens):
+    """ Create an aead_table (see example/aead_table.sql) holding the AEADs of `tokens'. """
+    engine = sqlalchemy.create_engine(db_url)
+    metadata = sqlalchemy.MetaData()
+    table = sqlalchemy.Table('aead_table', metadata,
+                             sqlalchemy.Column('public_id', sqlalchemy.String(16), primary_key = True),
+                             sqlalchemy.Column('keyhandle', sqlalchemy.Integer, primary_key = True),
+                             sqlalchemy.Column('aead', sqlalchemy.LargeBinary, nullable = False),
+                             sqlalchemy.Column('nonce', sqlalchemy.Text, nullable = False))
+    metadata.create_all(engine)
+    rows = [{'public_id': token.public_id,
+             'keyhandle': token.aead.key_handle,
+             'nonce': ''.join([ chr(c) for c in token.aead.nonce ]),
+             'aead': token.aead.data} for token in tokens]
+    with engine.begin() as connection:
+        connection.execute(table.insert(), rows)
+    engine.dispose()
+
+def populate_pack(pack_dir, key_handle, tokens):
+    """ Write the AEAD pack (see aead_pack) holding the AEADs of `tokens'. """
+    filename = aead_pack.aead_pack_filename(pack_dir, str(key_handle))
+    aead_pack.write_aead_pack(filename, key_handle, [(token.public_id, token.aead) for token in tokens])
+
+def mint_otps(tokens, count, rng):
+    """
+    Return `count' OTPs, going round robin over `tokens' with increasing
+    session use and counter values, so that no OTP is sent twice.
+    """
+    res = []
+    for i in range(count):
+        token = tokens[i % len(tokens)]
+        session = i // len(tokens)
+        res.append(token.otp(1 + (session // 256) % 0x7fff, session % 256,
+                             rng.getrandbits(24), rng.getrandbits(16)))
+    return res
+
+def percentile(sorted_values, pct):
+    """ Nearest-rank percentile of an already sorted list. """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+def summarize(latencies, errors, elapsed):
+    """ Return the load test results for a list of request latencies (seconds). """
+    latencies = sorted(latencies)
+    res = {'requests': len(latencies),
+           'errors': errors,
+           'seconds': elapsed,
+           'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0,
+           }
+    for name, pct in [('p50', 50), ('p99', 99), ('p999', 99.9)]:
+        value = percentile(latencies, pct)
+        res[name + '_ms'] = value * 1000 if value is not None else None
+    res['mean_ms'] = sum(latencies) / len(latencies) * 1000 if latencies else None
+    res['max_ms'] = latencies[-1] * 1000 if latencies else None
+    return res
+
+def free_port(addr):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind((addr, 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+class KSMProcess():
+    """ ksm.py running in a child process, for one backend. """
+    addr = '127.0.0.1'
+
+    def __init__(self, args, keys_file, backend_args, log_file):
+        self.port = args.port or free_port(self.addr)
+        cmd = [sys.executable, args.ksm, '-D', keys_file,
+               '--key-handle', str(args.key_handle),
+               '--addr', self.addr, '--port', str(self.port)]
+        cmd += backend_args + shlex.split(args.ksm_args)
+        if args.verbose:
+            print("Starting {}".format(' '.join([shlex.quote(this) for this in cmd])))
+        self.log_file = log_file
+        self._log = open(log_file, 'wb')
+        self.proc = subprocess.Popen(cmd, stdout = self._log, stderr = subprocess.STDOUT)
+
+    def wait_ready(self, timeout = 30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError("KSM exited with status {:d}, see '{}'".format(
+                    self.proc.returncode, self.log_file))
+            try:
+                socket.create_connection((self.addr, self.port), timeout = 1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("KSM not listening on port {:d} after {:d} seconds, see '{}'".format(
+            self.port, timeout, self.log_file))
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self._log.close()
+
+def _client(addr, port, url, otps, next_index, latencies, errors):
+    """ Send the OTPs picked off `next_index' over one keep-alive connection. """
+    conn = None
+    while True:
+        i = next(next_index)
+        if i >= len(otps):
+            break
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection(addr, port, timeout = 30)
+            conn.request('GET', url + otps[i])
+            response = conn.getresponse()
+            body = response.read()
+            if response.getheader('Connection', '').lower() == 'close':
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            if conn is not None:
+                conn.close()
+            conn = None
+            errors.append(i)
+            continue
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200 or not body.startswith(b'OK'):
+            errors.append(i)
+    if conn is not None:
+        conn.close()
+
+def drive(addr, port, otps, concurrency, url = default_serve_url):
+    """
+    Decrypt `otps' through the KSM at addr:port using `concurrency' client
+    threads. Returns (latencies, number of errors, elapsed seconds).
+    """
+    next_index = itertools.count()
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target = _client,
+                                args = (addr, port, url, otps, next_index, latencies, errors))
+               for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, len(errors), time.perf_counter() - start
+
+def load_test(args, work_dir, backend, otps, warmup_otps):
+    """ Start the KSM for `backend' and measure decrypting `otps' through it. """
+    backend_args = {'fs': ['-B', os.path.join(work_dir, 'aeads')],
+                    'sql': ['--db-url', 'sqlite:///' + os.path.join(work_dir, 'aeads.db')],
+                    'pack': ['--aead-pack', os.path.join(work_dir, 'packs')],
+                    }[backend]
+    ksm = KSMProcess(args, os.path.join(work_dir, 'keys.json'), backend_args,
+                     os.path.join(work_dir, 'ksm-{}.log'.format(backend)))
+    try:
+        ksm.wait_ready()
+        if warmup_otps:
+            drive(ksm.addr, ksm.port, warmup_otps, args.concurrency)
+        latencies, errors, elapsed = drive(ksm.addr, ksm.port, otps, args.concurrency)
+    finally:
+        ksm.stop()
+    return summarize(latencies, errors, elapsed)
+
+def time_it(func, repeat = 5):
+    """ Return the best time per call of `func' in nanoseconds. """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat = repeat, number = number)) / number * 1e9
+
+def micro_benchmarks(args, work_dir, hsm, tokens, rng):
+    """ Time the hot functions of the request path in-process. """
+    kh = args.key_handle
+    key = hsm.keys[kh]
+    token = tokens[0]
+    otp = token.otp(1, 0, 0, 0)
+    plaintext = token.uid + struct.pack('< H H B B H H', 1, 0, 0, 0, 0, 0)
+    public_ids = [this.public_id for this in tokens]
+    rng.shuffle(public_ids)
+    lookups = itertools.cycle(public_ids)
+
+    benchmarks = [
+        ('aesCCM', lambda: soft_hsm.aesCCM(key, kh, token.aead.nonce, token.aead.data, decrypt = True)),
+        ('crc16', lambda: soft_hsm.crc16(plaintext)),
+        ('modhex_decode', lambda: yubikey.modhex_decode(otp)),
+        ('validate_yubikey_with_aead', lambda: yubikey.validate_yubikey_with_aead(hsm, otp, token.aead, kh)),
+    ]
+    sources = []
+    if 'fs' in args.backends:
+        sources.append(('fs', FSBackend(os.path.join(work_dir, 'aeads'), [(str(kh), kh)])))
+    if 'sql' in args.backends:
+        sources.append(('sql', SQLBackend('sqlite:///' + os.path.join(work_dir, 'aeads.db'))))
+    if 'pack' in args.backends:
+        sources.append(('pack', PackBackend(os.path.join(work_dir, 'packs'), [(str(kh), kh)])))
+    for name, source in sources:
+        benchmarks.append(('load_aead_' + name, lambda source = source: source.load_aead(next(lookups))))
+
+    res = {}
+    try:
+        for name, func in benchmarks:
+            ns = time_it(func)
+            res[name] = {'ns_per_op': ns, 'ops_per_sec': 1e9 / ns}
+            if args.verbose:
+                print("{:30s} {:12.0f} ns/op".format(name, ns))
+    finally:
+        for _, source in sources:
+            source.close()
+    return res
+
+def _change(new, old):
+    if new is None or not old:
+        return ''
+    return "{:+.1f}%".format((new - old) / old * 100)
+
+def report(results, previous = None):
+    """ Print the results, and the change relative to `previous' results. """
+    previous = previous or {}
+    load = results.get('load', {})
+    if load:
+        old_load = previous.get('load', {})
+        print("{:6s} {:>9s} {:>7s} {:>11s} {:>9s} {:>9s} {:>9s}".format(
+            'load', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'p999 ms'))
+        for backend, this in sorted(load.items()):
+            print("{:6s} {:9d} {:7d} {:11.1f} {:9.3f} {:9.3f} {:9.3f}".format(
+                backend, this['requests'], this['errors'], this['throughput'],
+                this['p50_ms'] or 0, this['p99_ms'] or 0, this['p999_ms'] or 0))
+            old = old_load.get(backend)
+            if old:
+                print("{:6s} {:>9s} {:>7s} {:>11s} {:>9s} {:>9s} {:>9s}".format(
+                    '', '', '', _change(this['throughput'], old.get('throughput')),
+                    _change(this['p50_ms'], old.get('p50_ms')),
+                    _change(this['p99_ms'], old.get('p99_ms')),
+                    _change(this['p999_ms'], old.get('p999_ms'))))
+    micro = results.get('micro', {})
+    if micro:
+        old_micro = previous.get('micro', {})
+        print("{:30s} {:>12s} {:>14s} {:>9s}".format('micro', 'ns/op', 'ops/s', 'change'))
+        for name, this in micro.items():
+            old = old_micro.get(name, {})
+            print("{:30s} {:12.0f} {:14.0f} {:>9s}".format(
+                name, this['ns_per_op'], this['ops_per_sec'],
+                _change(this['ns_per_op'], old.get('ns_per_op'))))
+
+def main():
+    args = parse_args()
+    args_fixup(args)
+
+    rng = random.Random(args.seed)
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            previous = json.load(f)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix = 'ksm-bench-')
+    results = {'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'parameters': {'tokens': args.tokens,
+                              'requests': args.requests,
+                              'concurrency': args.concurrency,
+                              'warmup': args.warmup,
+                              'ksm_args': args.ksm_args,
+                              },
+               }
+    try:
+        os.makedirs(os.path.join(work_dir, 'aeads'), exist_ok = True)
+        os.makedirs(os.path.join(work_dir, 'packs'), exist_ok = True)
+        db_file = os.path.join(work_dir, 'aeads.db')
+        if os.path.exists(db_file):
+            os.unlink(db_file)
+
+        start = time.perf_counter()
+        hsm = make_keys(os.path.join(work_dir, 'keys.json'), args.key_handle)
+        tokens = make_tokens(hsm, args.key_handle, args.tokens)
+        populate_fs(os.path.join(work_dir, 'aeads'), args.key_handle, tokens)
+        populate_sql('sqlite:///' + db_file, tokens)
+        populate_pack(os.path.join(work_dir, 'packs'), args.key_handle, tokens)
+        otps = mint_otps(tokens, args.warmup + args.requests, rng)
+        if args.verbose:
+            print("Generated {:d} tokens and {:d} OTPs in '{}' ({:.1f}s)".format(
+                len(tokens), len(otps), work_dir, time.perf_counter() - start))
+
+        if args.requests:
+            results['load'] = {}
+            for backend in args.backends:
+                results['load'][backend] = load_test(args, work_dir, backend,
+                                                     otps[args.warmup:], otps[:args.warmup])
+        if args.micro:
+            results['micro'] = micro_benchmarks(args, work_dir, hsm, tokens, rng)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors = True)
+
+    report(results, previous)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+            f.write("\n")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
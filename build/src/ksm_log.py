@@ -0,0 +1,199 @@
+"""
+non-blocking logging for the KSM request path
+
+Request handlers put log records on a bounded in-memory queue and return
+immediately. A background thread drains the queue in batches to syslog (and
+stderr). Records are only formatted by that thread, success lines can be
+sampled, and floods of identical errors are rate limited.
+"""
+
+import collections
+import itertools
+import os
+import queue
+import sys
+import syslog
+import threading
+import time
+
+__all__ = [
+    # constants
+    # functions
+    # classes
+    'LogPipeline',
+]
+
+class _flush_marker():
+    def __init__(self):
+        self.done = threading.Event()
+
+class LogPipeline(object):
+    """
+    Asynchronous, bounded logging to syslog and stderr.
+
+    @param queue_size: Maximum number of queued records, more are dropped
+    @param batch_size: Maximum number of records written per batch
+    @param success_sample: Log one in this many success records (0 for none)
+    @param error_burst: Identical errors logged per `error_window' before suppressing them.
+                        Errors are identical if they have the same format and
+                        `limit_key' (by default, the same arguments)
+    @param error_window: Seconds of the error rate limit window (0 disables rate limiting)
+    @param count: Called with 'log_dropped', 'log_suppressed' or 'log_sampled_out'
+                  for every record not logged
+    @type queue_size: integer
+    @type batch_size: integer
+    @type success_sample: integer
+    @type error_burst: integer
+    @type error_window: integer
+    @type count: callable
+    """
+
+    # Number of distinct errors to keep rate limiting state for.
+    max_limits = 1000
+
+    def __init__(self, queue_size = 10000, batch_size = 100, success_sample = 1,
+                 error_burst = 10, error_window = 60, count = None):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.success_sample = success_sample
+        self.error_burst = error_burst
+        self.error_window = error_window
+        self.count = count
+        self.dropped = 0
+        self._init_state()
+        if hasattr(os, 'register_at_fork'):
+            # The writer thread does not survive fork(), and the queue might
+            # have been locked by it. Start over in the child.
+            os.register_at_fork(after_in_child = self._init_state)
+
+    def _init_state(self):
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._limit_lock = threading.Lock()
+        # (error template, limit key) -> [window start, records in window, suppressed],
+        # least recently seen first
+        self._limits = collections.OrderedDict()
+        self._successes = itertools.count()
+
+    def log(self, verbose, prio, fmt, *fmt_args, limit_key = None):
+        """
+        Queue a record for syslog, and also for stderr if `verbose' or if it is
+        an error. `fmt' is only %-formatted with `fmt_args' by the writer thread.
+
+        Errors are rate limited per `fmt' and `limit_key', which defaults to
+        the string values of `fmt_args'. Pass the part of the arguments that
+        tells errors apart (e.g. the public id and the error, but not the OTP).
+        """
+        suppressed = 0
+        if prio == syslog.LOG_ERR and self.error_window:
+            if limit_key is None:
+                limit_key = tuple([str(arg) for arg in fmt_args])
+            suppressed = self._rate_limit((fmt, limit_key))
+            if suppressed is None:
+                return
+        self._put((verbose, prio, fmt, fmt_args, suppressed))
+
+    def log_success(self, verbose, prio, fmt, *fmt_args):
+        """
+        Like log, but subject to sampling (see `success_sample').
+        """
+        if self.success_sample != 1:
+            if not self.success_sample or next(self._successes) % self.success_sample:
+                self._count('log_sampled_out')
+                return
+        self._put((verbose, prio, fmt, fmt_args, 0))
+
+    def flush(self, timeout = 5):
+        """ Wait until all records queued so far have been written. """
+        if self._thread is None or not self._thread.is_alive():
+            return
+        marker = _flush_marker()
+        try:
+            self._queue.put(marker, timeout = timeout)
+        except queue.Full:
+            return
+        marker.done.wait(timeout)
+
+    def _put(self, record):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._count('log_dropped')
+
+    def _count(self, name):
+        if self.count is not None:
+            self.count(name)
+
+    def _rate_limit(self, key):
+        """
+        Return None if a record for `key' should be suppressed, otherwise the
+        number of records for it suppressed since the last one logged.
+        """
+        now = time.monotonic()
+        with self._limit_lock:
+            limit = self._limits.get(key)
+            if limit is None or now - limit[0] >= self.error_window:
+                suppressed = limit[2] if limit is not None else 0
+                self._limits[key] = [now, 1, 0]
+                self._limits.move_to_end(key)
+                while len(self._limits) > self.max_limits:
+                    # forget the least recently seen error, not the ones flooding us
+                    self._limits.popitem(last = False)
+                return suppressed
+            self._limits.move_to_end(key)
+            if limit[1] < self.error_burst:
+                limit[1] += 1
+                return 0
+            limit[2] += 1
+        self._count('log_suppressed')
+        return None
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._writer, name = 'ksm-log')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _writer(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            self._write(batch)
+
+    def _write(self, batch):
+        stderr = []
+        for record in batch:
+            if isinstance(record, _flush_marker):
+                if stderr:
+                    self._write_stderr(stderr)
+                    stderr = []
+                record.done.set()
+                continue
+            verbose, prio, fmt, fmt_args, suppressed = record
+            try:
+                msg = fmt % fmt_args if fmt_args else fmt
+            except (TypeError, ValueError):
+                msg = "{} {}".format(fmt, fmt_args)
+            if suppressed:
+                msg = "{} ({:d} similar messages suppressed)".format(msg, suppressed)
+            syslog.syslog(prio, msg)
+            if verbose or prio == syslog.LOG_ERR:
+                stderr.append(msg)
+        if stderr:
+            self._write_stderr(stderr)
+
+    def _write_stderr(self, lines):
+        try:
+            sys.stderr.write("".join(["{}\n".format(line) for line in lines]))
+            sys.stderr.flush()
+        except (OSError, ValueError):
+            pass
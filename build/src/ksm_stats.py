@@ -0,0 +1,161 @@
+"""
+counters and latency histograms for the KSM, exported in Prometheus text format
+"""
+
+import bisect
+import multiprocessing
+import threading
+
+__all__ = [
+    # constants
+    'STAGES',
+    'BUCKETS',
+    # functions
+    # classes
+    'KSMStats',
+]
+
+# Stages of handling a request that get a latency histogram.
+STAGES = ('input', 'load_aead', 'validate', 'write', 'batch_load_aeads', 'batch_validate')
+
+# Histogram bucket upper bounds, in seconds.
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# counter name -> (metric, label name, label value, help)
+_counters = [
+    ('ok', ('ksm_otp_requests_total', 'result', 'ok', 'OTPs handled, by result.')),
+    ('invalid', ('ksm_otp_requests_total', 'result', 'invalid', None)),
+    ('no_aead', ('ksm_otp_requests_total', 'result', 'no_aead', None)),
+    ('err', ('ksm_otp_requests_total', 'result', 'err', None)),
+    ('cache_hit', ('ksm_aead_cache_total', 'event', 'hit', 'AEAD cache lookups and evictions.')),
+    ('cache_miss', ('ksm_aead_cache_total', 'event', 'miss', None)),
+    ('cache_negative_hit', ('ksm_aead_cache_total', 'event', 'negative_hit', None)),
+    ('cache_eviction', ('ksm_aead_cache_total', 'event', 'eviction', None)),
+    ('key_cache_hit', ('ksm_key_cache_total', 'event', 'hit',
+                       'Unwrapped YubiKey key cache lookups and evictions, a hit skips the AEAD decryption.')),
+    ('key_cache_miss', ('ksm_key_cache_total', 'event', 'miss', None)),
+    ('key_cache_eviction', ('ksm_key_cache_total', 'event', 'eviction', None)),
+    ('log_dropped', ('ksm_log_records_total', 'event', 'dropped',
+                     'Log records not written, by reason.')),
+    ('log_suppressed', ('ksm_log_records_total', 'event', 'suppressed', None)),
+    ('log_sampled_out', ('ksm_log_records_total', 'event', 'sampled_out', None)),
+    ('sql_pool_checkout', (None, None, None, None)),
+    ('sql_pool_checkin', (None, None, None, None)),
+]
+
+class KSMStats(object):
+    """
+    Request counters and per-stage latency histograms.
+
+    Everything lives in shared memory with one row per worker process, so
+    that every pre-forked worker updates its own row and any worker can
+    report the totals. Updating is a couple of array writes under a lock only
+    shared with the threads of the same worker, cheap enough to leave on.
+
+    Besides the fixed counters, there is one 'fs_miss' counter per key handle
+    in `key_handles', counted as inc(('fs_miss', key_handle)).
+    """
+
+    names = tuple([name for (name, _) in _counters])
+
+    def __init__(self, workers = 1, key_handles = ()):
+        self.key_handles = tuple(key_handles)
+        keys = list(self.names) + [('fs_miss', kh) for kh in self.key_handles]
+        self._index = dict((name, i) for (i, name) in enumerate(keys))
+        self._num_counters = len(keys)
+        self._num_buckets = len(BUCKETS) + 1
+        self._workers = workers
+        self._counters = multiprocessing.RawArray('Q', workers * self._num_counters)
+        # per stage : bucket counts, then the total count
+        self._hist_width = len(STAGES) * (self._num_buckets + 1)
+        self._hist = multiprocessing.RawArray('Q', workers * self._hist_width)
+        self._sums = multiprocessing.RawArray('d', workers * len(STAGES))
+        self._stage_index = dict((stage, i) for (i, stage) in enumerate(STAGES))
+        self._worker = 0
+        self._lock = threading.Lock()
+
+    def set_worker(self, worker):
+        """ Select the row of counters updated by this process. """
+        self._worker = worker
+
+    def inc(self, name):
+        """ Increment counter `name' for this worker. """
+        idx = self._worker * self._num_counters + self._index[name]
+        with self._lock:
+            self._counters[idx] += 1
+
+    def observe(self, stage, seconds):
+        """ Record that `stage' of a request took `seconds'. """
+        i = self._stage_index[stage]
+        base = self._worker * self._hist_width + i * (self._num_buckets + 1)
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self._hist[base + bucket] += 1
+            self._hist[base + self._num_buckets] += 1
+            self._sums[self._worker * len(STAGES) + i] += seconds
+
+    def totals(self):
+        """ Return the counters summed over all workers. """
+        res = dict((name, 0) for name in self._index)
+        for worker in range(self._workers):
+            base = worker * self._num_counters
+            for name, i in self._index.items():
+                res[name] += self._counters[base + i]
+        return res
+
+    def histogram(self, stage):
+        """
+        Return (cumulative bucket counts, count, sum) for `stage' summed over all workers.
+        """
+        i = self._stage_index[stage]
+        buckets = [0] * self._num_buckets
+        count = 0
+        total = 0.0
+        for worker in range(self._workers):
+            base = worker * self._hist_width + i * (self._num_buckets + 1)
+            for b in range(self._num_buckets):
+                buckets[b] += self._hist[base + b]
+            count += self._hist[base + self._num_buckets]
+            total += self._sums[worker * len(STAGES) + i]
+        for b in range(1, self._num_buckets):
+            buckets[b] += buckets[b - 1]
+        return buckets, count, total
+
+    def prometheus(self):
+        """ Return all statistics in the Prometheus text exposition format. """
+        totals = self.totals()
+        out = []
+        for name, (metric, label, value, help_text) in _counters:
+            if metric is None:
+                continue
+            if help_text:
+                out.append("# HELP {} {}".format(metric, help_text))
+                out.append("# TYPE {} counter".format(metric))
+            out.append('{}{{{}="{}"}} {:d}'.format(metric, label, value, totals[name]))
+
+        out.append("# HELP ksm_sql_pool_checked_out SQL backend connections currently checked out of the pools.")
+        out.append("# TYPE ksm_sql_pool_checked_out gauge")
+        out.append("ksm_sql_pool_checked_out {:d}".format(
+            totals['sql_pool_checkout'] - totals['sql_pool_checkin']))
+
+        if self.key_handles:
+            out.append("# HELP ksm_fs_lookup_misses_total AEAD files not found, by key handle.")
+            out.append("# TYPE ksm_fs_lookup_misses_total counter")
+            for kh in self.key_handles:
+                out.append('ksm_fs_lookup_misses_total{{key_handle="{}"}} {:d}'.format(kh, totals[('fs_miss', kh)]))
+
+        out.append("# HELP ksm_stage_duration_seconds Time spent in each stage of handling a request.")
+        out.append("# TYPE ksm_stage_duration_seconds histogram")
+        for stage in STAGES:
+            buckets, count, total = self.histogram(stage)
+            for bound, value in zip(BUCKETS, buckets):
+                out.append('ksm_stage_duration_seconds_bucket{{stage="{}",le="{}"}} {:d}'.format(stage, bound, value))
+            out.append('ksm_stage_duration_seconds_bucket{{stage="{}",le="+Inf"}} {:d}'.format(stage, count))
+            out.append('ksm_stage_duration_seconds_sum{{stage="{}"}} {}'.format(stage, repr(total)))
+            out.append('ksm_stage_duration_seconds_count{{stage="{}"}} {:d}'.format(stage, count))
+
+        out.append("# HELP ksm_workers Number of worker processes.")
+        out.append("# TYPE ksm_workers gauge")
+        out.append("ksm_workers {:d}".format(self._workers))
+        return "\n".join(out) + "\n"
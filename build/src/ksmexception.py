@@ -14,7 +14,8 @@ __all__ = [
     'YHSM_InputTooLong',
     'YHSM_WrongInputSize',
     'YHSM_WrongInputType',
-    'YHSM_CommandFailed'
+    'YHSM_CommandFailed',
+    'YHSM_AEADNotFound',
 ]
 
 import defines
@@ -81,3 +82,11 @@ class YHSM_CommandFailed(YHSM_Error):
         self.status_str = defines.status2str(status)
         reason = "Command %s failed: %s" % (name, self.status_str)
         YHSM_Error.__init__(self, reason)
+
+class YHSM_AEADNotFound(YHSM_Error):
+    """
+    Exception raised by AEAD backends when there is no AEAD for a public id.
+    """
+    def __init__(self, public_id, reason):
+        self.public_id = public_id
+        YHSM_Error.__init__(self, reason)
@@ -9,6 +9,11 @@ import struct
 import json
 import os
 import sys
+import collections
+import hashlib
+import hmac
+import threading
+import time
 
 import aead_cmd
 import soft_hsm
@@ -30,110 +35,134 @@ import util
 from Crypto.Cipher import AES
 
 
-def _xor_block(a, b):
-    """ XOR two blocks of equal length. """
-    return bytes([x ^ y for (x, y) in zip(a, b)])
+# aesCtr block prefix : flags, key handle and nonce, followed by a big endian 16 bit counter
+_ctr_prefix = struct.Struct('< B I {:d}s 3x'.format(defines.YSM_AEAD_NONCE_SIZE))
+_ctr_flags = defines.YSM_CCM_CTR_SIZE - 1
+_mac_flags = (((defines.YSM_AEAD_MAC_SIZE - 2) // 2) << 3) | (defines.YSM_CCM_CTR_SIZE - 1)
+# use_ctr, ts_low, ts_high, session_ctr, rnd, crc following the uid in a decrypted OTP
+_otp_fields = struct.Struct('< H H B B H H')
 
-class _ctr_counter():
-    """
-    An object implementation of the struct aesCtr.
-    """
-    def __init__(self, key_handle, nonce, flags = None, value = 0):
-        self.flags = defines.YSM_CCM_CTR_SIZE - 1 if flags is None else flags
-        self.key_handle = key_handle
-        self.nonce = nonce
-        self.value = value
-
-    def __next__(self):
-        """
-        Return next counter value, encoded into YSM_BLOCK_SIZE.
-        """
-        self.value += 1
-        return self.pack()
-
-    def pack(self):
-        fmt = '< B I {:d}s BBB 2s'.format(defines.YSM_AEAD_NONCE_SIZE)
-        val = struct.pack('> H', self.value)
-        return struct.pack(fmt,
-                           self.flags,
-                           self.key_handle,
-                           self.nonce,
-                           0, 0, 0, # rfu
-                           val
-                           )
-
-
-class _cbc_mac():
-    def __init__(self, key, key_handle, nonce, data_len):
-        """
-        Initialize CBC-MAC like the YubiHSM does.
-        """
-        flags = (((defines.YSM_AEAD_MAC_SIZE - 2) // 2) << 3) | (defines.YSM_CCM_CTR_SIZE - 1)
-        t = _ctr_counter(key_handle, nonce, flags = flags, value = data_len)
-        t_mac = t.pack()
-        self.mac_aes = AES.new(key, AES.MODE_ECB)
-        self.mac = self.mac_aes.encrypt(t_mac)
-
-    def update(self, block):
-        block = block.ljust(defines.YSM_BLOCK_SIZE, b"\x00")
-        t1 = _xor_block(self.mac, block)
-        t2 = self.mac_aes.encrypt(t1)
-        self.mac = t2
-
-    def finalize(self, block):
-        """
-        The final step of CBC-MAC encrypts before xor.
-        """
-        t1 = self.mac_aes.encrypt(block)
-        t2 = _xor_block(self.mac, t1)
-        self.mac = t2
-
-    def get(self):
-        return self.mac[: defines.YSM_AEAD_MAC_SIZE]
 
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x8408
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
 
-def _split_data(data, pos):
-    a = data[:pos]
-    b = data[pos:]
-    return (a, b,)
+_crc16_lookup = _crc16_table()
 
 
-def aesCCM(key, key_handle, nonce, data, decrypt=False):
+class _unwrapped_key_cache():
+    """
+    Bounded LRU cache of YubiKey AES keys unwrapped from AEADs, keyed by a
+    digest of (key_handle, nonce, aead).
+
+    Each entry holds a ready AES ECB cipher for the YubiKey key plus the uid,
+    so repeat validations skip the CCM decryption of the AEAD. As this is key
+    material, the number of entries is capped and entries can expire. Nothing
+    is scrubbed : the key lives on in the cipher object (whose key schedule
+    is freed, not wiped, by the crypto library) and in immutable bytes
+    objects until the garbage collector reuses their memory.
+    """
+    def __init__(self, size, ttl = 0, count = None):
+        if size < 1:
+            raise ValueError('Key cache size must be at least 1, was %d' % (size))
+        self.size = size
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._count = count if count is not None else (lambda name: None)
+        # digest -> (expires, ecb_aes, uid)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(key_handle, nonce, aead):
+        return hashlib.sha256(struct.pack('< I', key_handle) + nonce + aead).digest()
+
+    def get(self, digest):
+        """ Return (ecb_aes, uid) for digest, or None. """
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                del self._entries[digest]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+        if entry is None:
+            self._count('key_cache_miss')
+            return None
+        self._count('key_cache_hit')
+        return (entry[1], entry[2])
+
+    def put(self, digest, ecb_aes, uid):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        evicted = 0
+        with self._lock:
+            self._entries[digest] = (expires, ecb_aes, uid)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+                evicted += 1
+            self.evictions += evicted
+        for _ in range(evicted):
+            self._count('key_cache_eviction')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def aesCCM(key, key_handle, nonce, data, decrypt=False, key_aes=None):
     """
     Function implementing YubiHSM AEAD encrypt/decrypt in software.
+
+    `key_aes' is an optional AES ECB cipher object for `key', to be
+    reused when processing many AEADs with the same key.
     """
+    mac_size = defines.YSM_AEAD_MAC_SIZE
+    block_size = defines.YSM_BLOCK_SIZE
 
     if decrypt:
-        (data, saved_mac) = _split_data(data, len(data) - defines.YSM_AEAD_MAC_SIZE)
+        saved_mac = data[len(data) - mac_size:]
+        data = data[:len(data) - mac_size]
 
     nonce = util.input_validate_nonce(nonce, pad = True)
-    mac = _cbc_mac(key, key_handle, nonce, len(data))
-
-    counter = _ctr_counter(key_handle, nonce, value = 0)
-    ctr_aes = AES.new(key, AES.MODE_CTR, counter = counter.__next__)
-    out = []
-    while data:
-        (thisblock, data) = _split_data(data, defines.YSM_BLOCK_SIZE)
-
-        # encrypt/decrypt and CBC MAC
-        if decrypt:
-            aes_out = ctr_aes.decrypt(thisblock)
-            mac.update(aes_out)
-        else:
-            mac.update(thisblock)
-            aes_out = ctr_aes.encrypt(thisblock)
-
-        out.append(aes_out)
+    aes = key_aes if key_aes is not None else AES.new(key, AES.MODE_ECB)
+    data_len = len(data)
+    num_blocks = (data_len + block_size - 1) // block_size
+
+    # CTR keystream for all blocks in a single call. Counter block 0 is used
+    # to finalize the MAC, the data is encrypted with blocks 1..num_blocks.
+    prefix = _ctr_prefix.pack(_ctr_flags, key_handle, nonce)
+    keystream = aes.encrypt(b''.join([prefix + i.to_bytes(2, 'big') for i in range(num_blocks + 1)]))
+    out = (int.from_bytes(data, 'big') ^
+           int.from_bytes(keystream[block_size:block_size + data_len], 'big')).to_bytes(data_len, 'big')
+    plaintext = out if decrypt else data
+
+    # CBC-MAC of the (zero padded) plaintext, like the YubiHSM does.
+    mac = int.from_bytes(aes.encrypt(_ctr_prefix.pack(_mac_flags, key_handle, nonce) +
+                                     data_len.to_bytes(2, 'big')), 'big')
+    plaintext = plaintext + b'\x00' * (-data_len % block_size)
+    for offset in range(0, len(plaintext), block_size):
+        mac ^= int.from_bytes(plaintext[offset:offset + block_size], 'big')
+        mac = int.from_bytes(aes.encrypt(mac.to_bytes(block_size, 'big')), 'big')
+    mac ^= int.from_bytes(keystream[:block_size], 'big')
+    mac = mac.to_bytes(block_size, 'big')[:mac_size]
 
-    # Finalize MAC
-    counter.value = 0
-    mac.finalize(counter.pack())
     if decrypt:
-        if mac.get() != saved_mac:
+        if not hmac.compare_digest(mac, saved_mac):
             raise ksmexception.YHSM_Error('AEAD integrity check failed')
-    else:
-        out.append(mac.get())
-    return b''.join(out)
+        return out
+    return out + mac
 
 
 def crc16(data):
@@ -141,13 +170,9 @@ def crc16(data):
     Calculate an ISO13239 CRC checksum of the input buffer.
     """
     m_crc = 0xffff
+    table = _crc16_lookup
     for this in data:
-        m_crc ^= this
-        for _ in range(8):
-            j = m_crc & 1
-            m_crc >>= 1
-            if j:
-                m_crc ^= 0x8408
+        m_crc = (m_crc >> 8) ^ table[(m_crc ^ this) & 0xff]
     return m_crc
 
 
@@ -161,6 +186,7 @@ class SoftYHSM(object):
             if len(v) not in AES.key_size:
                 raise ValueError('Keyhandle of unsupported length: %d (was %d bytes)' % (k, len(v)))
         self.keys = keys
+        self._key_cache = None
 
     @classmethod
     def from_file(cls, filename, debug=False):
@@ -179,6 +205,21 @@ class SoftYHSM(object):
             keys[int(kh)] = binascii.unhexlify(aes_key_hex)
         return cls(keys, debug)
 
+    def enable_key_cache(self, size, ttl = 0, count = None):
+        """
+        Remember up to `size' YubiKey AES keys unwrapped from AEADs in
+        validate_aead_otp, for `ttl' seconds (0 for no expiry). `size' is a
+        number of entries, not bytes. `count' is called with the name of a
+        counter to increment on cache hits, misses and evictions.
+        """
+        self.disable_key_cache()
+        self._key_cache = _unwrapped_key_cache(size, ttl, count)
+
+    def disable_key_cache(self):
+        if self._key_cache is not None:
+            self._key_cache.clear()
+        self._key_cache = None
+
     def _get_key(self, kh, cmd):
         try:
             return self.keys[kh]
@@ -189,18 +230,49 @@ class SoftYHSM(object):
 
     def validate_aead_otp(self, public_id, otp, key_handle, aead):
         aes_key = self._get_key(key_handle, defines.YSM_AEAD_YUBIKEY_OTP_DECODE)
+        return self._validate_aead_otp(aes_key, None, public_id, otp, key_handle, aead)
+
+    def validate_aead_otps(self, key_handle, otps):
+        """
+        Validate a batch of OTPs whose AEADs are all encrypted with `key_handle'.
+
+        `otps' is a list of (public_id, otp, aead) tuples. The key is looked up
+        and prepared once for the whole batch. Returns a list with, for each
+        input, either a YHSM_ValidationResult or the YHSM_Error it failed with.
+        """
+        aes_key = self._get_key(key_handle, defines.YSM_AEAD_YUBIKEY_OTP_DECODE)
+        key_aes = AES.new(aes_key, AES.MODE_ECB)
+        res = []
+        for (public_id, otp, aead) in otps:
+            try:
+                res.append(self._validate_aead_otp(aes_key, key_aes, public_id, otp, key_handle, aead))
+            except ksmexception.YHSM_Error as e:
+                res.append(e)
+        return res
+
+    def _validate_aead_otp(self, aes_key, key_aes, public_id, otp, key_handle, aead):
         cmd = validate_cmd.YHSM_Cmd_AEAD_Validate_OTP(None, public_id, otp, key_handle, aead)
 
-        aead_pt = aesCCM(aes_key, cmd.key_handle, cmd.public_id, aead, True)
-        yk_key, yk_uid = aead_pt[:16], aead_pt[16:]
+        key_cache = self._key_cache
+        cached = None
+        if key_cache is not None:
+            digest = key_cache.digest(cmd.key_handle, cmd.public_id, aead)
+            cached = key_cache.get(digest)
+
+        if cached is None:
+            aead_pt = aesCCM(aes_key, cmd.key_handle, cmd.public_id, aead, True, key_aes)
+            yk_key, yk_uid = aead_pt[:16], aead_pt[16:]
     
-        ecb_aes = AES.new(yk_key, AES.MODE_ECB)
+            ecb_aes = AES.new(yk_key, AES.MODE_ECB)
+            if key_cache is not None:
+                key_cache.put(digest, ecb_aes, yk_uid)
+        else:
+            ecb_aes, yk_uid = cached
         
         otp_plain = ecb_aes.decrypt(otp)
         
         uid = otp_plain[:6]
-        use_ctr, ts_low, ts_high, session_ctr, rnd, crc = struct.unpack(
-            '<HHBBHH', otp_plain[6:])
+        use_ctr, ts_low, ts_high, session_ctr, rnd, crc = _otp_fields.unpack_from(otp_plain, 6)
 
         if uid == yk_uid and crc16(otp_plain) == 0xf0b8:
             return validate_cmd.YHSM_ValidationResult(
@@ -217,7 +289,7 @@ class SoftYHSM(object):
         self._buffer = self._buffer[:offset] + os.urandom(num_bytes)
 
     def generate_aead(self, nonce, key_handle):
-        if nonce == "":
+        if not nonce:
             # no hardware to generate it for us, so do it here.
             nonce = os.urandom(6)
         aes_key = self._get_key(key_handle, defines.YSM_BUFFER_AEAD_GENERATE)
@@ -14,6 +14,7 @@ __all__ = [
     # functions
     'validate_otp',
     'validate_yubikey_with_aead',
+    'validate_yubikeys_with_aead',
     'modhex_encode',
     'modhex_decode',
     'split_id_otp',
@@ -52,11 +53,48 @@ def validate_otp(hsm, from_key):
 
 def validate_yubikey_with_aead(hsm, from_key, aead, key_handle):
 
+    key_handle = util.input_validate_key_handle(key_handle)
+    nonce, otp, aead = _aead_otp_args(from_key, aead)
+
+    return hsm.validate_aead_otp(nonce, otp,
+        key_handle, aead)
+
+def validate_yubikeys_with_aead(hsm, otps, key_handle):
+    """
+    Validate a batch of OTPs from YubiKeys whose AEADs all use the same key handle.
+
+    @param hsm: The YHSM instance
+    @param otps: (from_key, aead) pairs, `from_key' being the modhex OTP
+    @param key_handle: The key handle of all the AEADs
+    @type hsm: L{SoftYHSM}
+    @type otps: list of tuple
+    @type key_handle: integer or string
+
+    @returns: for each input, either a validation response or the exception it failed with
+    @rtype: list of L{YHSM_ValidationResult} or L{ksmexception.YHSM_Error}
+    """
+    key_handle = util.input_validate_key_handle(key_handle)
+    res = [None] * len(otps)
+    todo = []
+    for i, (from_key, aead) in enumerate(otps):
+        try:
+            todo.append((i, _aead_otp_args(from_key, aead)))
+        except ksmexception.YHSM_Error as e:
+            res[i] = e
+    if todo:
+        results = hsm.validate_aead_otps(key_handle, [args for (_, args) in todo])
+        for (i, _), this in zip(todo, results):
+            res[i] = this
+    return res
+
+def _aead_otp_args(from_key, aead):
+    """
+    Return the (nonce, otp, aead) the HSM needs to validate `from_key' using `aead'.
+    """
     from_key = util.input_validate_str(from_key, 'from_key', max_len = 48)
     
     nonce = aead.nonce
     aead = util.input_validate_aead(aead)
-    key_handle = util.input_validate_key_handle(key_handle)
 
     public_id, otp = split_id_otp(from_key)
 
@@ -66,8 +104,7 @@ def validate_yubikey_with_aead(hsm, from_key, aead, key_handle):
     if not nonce:
         nonce = bytes.fromhex(public_id)
     
-    return hsm.validate_aead_otp(nonce, bytes.fromhex(otp),
-        key_handle, aead)
+    return nonce, bytes.fromhex(otp), aead
 
 def modhex_decode(data):
     """